@@ -0,0 +1,61 @@
+# Benchmark of the hikes archive over years of history, eg:
+#   python benchmarks/bench_archive.py --years 1 5 --hikes-per-month 300
+# Measures archiving the hikes of one refresh and the history commands, which only read the
+# partitions they need
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from common import bot, make_rows, measure, report, use_temp_database
+
+# make_rows spreads hikes over about half a year
+BATCH_MONTHS = 6
+
+
+# Hikes of years of history with distinct ids, oldest first
+def make_history(years, hikes_per_month):
+    start = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0) - timedelta(days = 365 * years)
+    batch = hikes_per_month * BATCH_MONTHS
+    hikes = []
+    for number in range(years * 12 // BATCH_MONTHS):
+        for row in make_rows(batch, seed = number, start = start + timedelta(days = 182 * number)):
+            row[5] = str(int(row[5]) + number * batch)
+            hikes.append(bot.parse_hike(row))
+    return hikes
+
+
+def run(years = (1, 5), hikes_per_month = 300, refresh = 50, repeat = 5):
+    directory = use_temp_database()
+    results = []
+    for count in years:
+        archive = bot.HikesArchive(os.path.join(directory, 'archive-%d' % count))
+        hikes = make_history(count, hikes_per_month)
+        archive.record(hikes)
+        partitions = archive.partitions()
+        size = sum(os.path.getsize(archive.partition_path(month, 'dat')) for month in partitions)
+        params = dict(years = count, hikes = len(hikes), partitions = len(partitions))
+        # A refresh updates a few of the latest hikes
+        latest = hikes[-refresh:]
+        results.append(measure('archive_record', lambda: archive.record(latest), repeat, refresh = refresh,
+            **params))
+        organiser = hikes[len(hikes) // 2].organiser
+        results.append(measure('archive_history', lambda: archive.history(organiser), repeat,
+            matches = len(archive.history(organiser)), **params))
+        results.append(measure('archive_history_all_partitions', lambda: archive.history('no such organiser'),
+            repeat, **params))
+        results.append(measure('archive_counts', lambda: archive.counts(), repeat, bytes = size, **params))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the hikes archive')
+    parser.add_argument('--years', type = int, nargs = '+', default = [1, 5])
+    parser.add_argument('--hikes-per-month', type = int, default = 300)
+    parser.add_argument('--refresh', type = int, default = 50)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+    report(run(args.years, args.hikes_per_month, args.refresh, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
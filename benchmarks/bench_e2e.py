@@ -0,0 +1,73 @@
+# End to end load test: the bot polls a fake Telegram API, answers commands over a hike set
+# served by the fake upstream, and the latency from update to reply is measured, eg:
+#   python benchmarks/bench_e2e.py --hikes 2000 --commands 200 --chats 50
+import argparse
+import random
+import time
+
+from telegram.ext import Updater
+
+from common import bot, make_rows, report, summarize, use_temp_database
+from fakes import FakeTelegram, FakeUpstream
+
+COMMANDS = ['/eventsall', '/eventsweek', '/eventsweek T2 T4', '/eventsorganiser organiser 1',
+            '/eventsdate - - sat,sun']
+
+
+def run(hikes = 2000, commands = 200, chats = 50, seed = 0):
+    use_temp_database()
+    rng = random.Random(seed)
+    upstream = FakeUpstream(make_rows(hikes), etags = True).start()
+    telegram = FakeTelegram().start()
+    bot.EVENT_LIST_URL = upstream.url
+    bot.__outbox__ = None
+    updater = Updater(token = '123456:BENCHMARK', base_url = telegram.base_url, workers = 8)
+    bot.add_handlers(updater.dispatcher)
+    loader = bot.HikesLoader(30)
+    loader.task()
+    results = []
+    try:
+        updater.start_polling(poll_interval = 0, timeout = bot.UPDATES_POLL_TIMEOUT)
+
+        # One command at a time gives the latency of a single reply
+        latencies = []
+        for index in range(commands):
+            chat_id = 1000000 + index
+            start = time.perf_counter()
+            telegram.push_command(chat_id, rng.choice(COMMANDS))
+            if telegram.wait_for_messages(chat_id):
+                latencies.append(time.perf_counter() - start)
+        results.append(summarize('command_latency', latencies, hikes = hikes, commands = commands,
+            answered = len(latencies)))
+
+        # A burst from many chats at once gives the throughput of the dispatcher
+        start = time.perf_counter()
+        for index in range(commands):
+            telegram.push_command(index % chats + 1, rng.choice(COMMANDS))
+        answered = 0
+        for chat_id in range(1, chats + 1):
+            expected = len(range(chat_id - 1, commands, chats))
+            if len(telegram.wait_for_messages(chat_id, expected)) >= expected:
+                answered += expected
+        elapsed = time.perf_counter() - start
+        results.append(dict(benchmark = 'command_throughput', hikes = hikes, commands = commands,
+            chats = chats, answered = answered, seconds = elapsed,
+            commands_per_second = answered / elapsed if elapsed else 0.0))
+    finally:
+        updater.stop()
+        upstream.stop()
+        telegram.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Load test the bot against fake servers')
+    parser.add_argument('--hikes', type = int, default = 2000)
+    parser.add_argument('--commands', type = int, default = 200)
+    parser.add_argument('--chats', type = int, default = 50)
+    args = parser.parse_args()
+    report(run(args.hikes, args.commands, args.chats))
+
+
+if __name__ == '__main__':
+    main()
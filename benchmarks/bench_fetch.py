@@ -0,0 +1,49 @@
+# Benchmark of fetching the event list from a local fake upstream: cold and cached
+# pagination and a full HikesLoader tick, eg:
+#   python benchmarks/bench_fetch.py --rows 1000 5000 --page-size 100 500
+import argparse
+
+from common import bot, make_rows, measure, report, use_temp_database
+from fakes import FakeUpstream
+
+
+def run(row_counts = (1000, 5000), page_sizes = (100, 500), repeat = 5):
+    use_temp_database()
+    results = []
+    for count in row_counts:
+        rows = make_rows(count)
+        for etags in (False, True):
+            upstream = FakeUpstream(rows, etags = etags).start()
+            bot.EVENT_LIST_URL = upstream.url
+            try:
+                for page_size in page_sizes:
+                    bot.PAGE_SIZE = page_size
+                    params = dict(rows = count, page_size = page_size, etags = etags)
+                    results.append(measure('fetch_cold', lambda: bot.makerequest(), repeat, **params))
+                    cache = bot.FetchCache()
+                    bot.makerequest(cache = cache)
+                    results.append(measure('fetch_cached', lambda: bot.makerequest(cache = cache), repeat,
+                        **params))
+
+                    loader = bot.HikesLoader(30)
+                    results.append(measure('loader_tick_unchanged', loader.task, repeat, **params))
+                    # Every tick sees a fresh set of rows to parse, diff and publish
+                    versions = iter(range(1, repeat + 1))
+                    results.append(measure('loader_tick_changed', loader.task, repeat,
+                        setup = lambda: upstream.set_rows(make_rows(count, seed = next(versions))), **params))
+            finally:
+                upstream.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark fetching the event list')
+    parser.add_argument('--rows', type = int, nargs = '+', default = [1000, 5000])
+    parser.add_argument('--page-size', type = int, nargs = '+', default = [100, 500])
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+    report(run(args.rows, args.page_size, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Micro-benchmark of the event list payload parser on synthetic payloads.
+# Prints one JSON object per measurement, eg:
+#   python benchmarks/bench_parser.py --rows 10000
+import argparse
+import io
+
+from common import bot, make_payload, make_rows, measure, report
+
+
+def run(rows_count = 10000, repeat = 5):
+    rows = make_rows(rows_count)
+    payload = make_payload(rows)
+    results = []
+
+    for backend in bot.JSON_BACKENDS:
+        try:
+            loads = __import__(backend).loads
+        except ImportError:
+            continue
+        results.append(measure('decode', lambda: loads(payload), repeat, backend = backend, rows = rows_count))
+    results.append(measure('decode_streaming', lambda: sum(1 for _ in bot.iter_event_rows(io.BytesIO(payload))),
+        repeat, streaming = bot.ijson is not None, rows = rows_count))
+
+    def parse_cold():
+        bot.parse_date_string.cache_clear()
+        bot.to_timestamp.cache_clear()
+        for row in rows:
+            bot.parse_hike(row)
+    results.append(measure('parse_rows_cold_cache', parse_cold, repeat, rows = rows_count))
+    results.append(measure('parse_rows_warm_cache', lambda: [bot.parse_hike(row) for row in rows], repeat,
+        rows = rows_count))
+
+    def refresh_full():
+        bot.HikesLoader(30).refresh(rows)
+    results.append(measure('refresh_full', refresh_full, repeat, rows = rows_count))
+    loader = bot.HikesLoader(30)
+    loader.refresh(rows)
+    results.append(measure('refresh_unchanged', lambda: loader.refresh(rows), repeat, rows = rows_count))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the event list parser')
+    parser.add_argument('--rows', type = int, default = 10000)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+    report(run(args.rows, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
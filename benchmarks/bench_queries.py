@@ -0,0 +1,53 @@
+# Benchmark of the read commands over hike stores of growing size, eg:
+#   python benchmarks/bench_queries.py --hikes 1000 10000 100000
+import argparse
+from datetime import datetime, timedelta
+
+from common import bot, make_rows, measure, publish_rows, report
+
+
+def clear_query_cache():
+    bot.__query_cache__ = None
+
+
+def run(hike_counts = (1000, 10000, 100000), repeat = 20):
+    results = []
+    for count in hike_counts:
+        publish_rows(make_rows(count))
+        store = bot.get_hike_store()
+        organiser = store.hikes[len(store.hikes) // 2].organiser
+        today = datetime.now()
+        month = (today.strftime('%Y-%m-%d'), (today + timedelta(days = 30)).strftime('%Y-%m-%d'))
+        queries = [
+            ('eventsall', lambda: bot.get_eventsall()),
+            ('eventsweek', lambda: bot.get_eventsweek(bot.Difficulty.T2, bot.Difficulty.T4)),
+            ('eventsorganiser_exact', lambda: bot.get_eventsorganiser(organiser)),
+            ('eventsorganiser_substring', lambda: bot.get_eventsorganiser('nis')),
+            ('eventsdate_month', lambda: bot.get_eventsdate(*month)),
+        ]
+        for name, query in queries:
+            results.append(measure(name, query, repeat, hikes = count, matches = len(query())))
+        for query in ['herzogstand', 'organiser 1', 'orgnaiser', 'hike t3', 't2 t4']:
+            key, words, partial, difficulties = bot.parse_inline_query(query)
+            results.append(measure('inline_search', lambda: store.search.search(words, partial, difficulties),
+                repeat, hikes = count, query = query))
+        results.append(measure('search_index_build', lambda: bot.SearchIndex(store), min(repeat, 5), hikes = count))
+        for text in ['/eventsall', '/eventsweek T2 T4', '/eventsorganiser %s' % organiser]:
+            command = bot.parse_command(text.split()[0][1:], text.split()[1:])
+            results.append(measure('render_command_cold', lambda: bot.render_command(command), repeat,
+                setup = clear_query_cache, hikes = count, command = text))
+            results.append(measure('render_command_cached', lambda: bot.render_command(command), repeat,
+                hikes = count, command = text))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the read commands')
+    parser.add_argument('--hikes', type = int, nargs = '+', default = [1000, 10000, 100000])
+    parser.add_argument('--repeat', type = int, default = 20)
+    args = parser.parse_args()
+    report(run(args.hikes, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
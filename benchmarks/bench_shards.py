@@ -0,0 +1,84 @@
+# Benchmark of subscription notifications on worker processes against matching in process, eg:
+#   python benchmarks/bench_shards.py --shards 0 1 2 4 --subscriptions 20000
+# 0 shards matches in this process. Every run publishes a snapshot with new hikes and measures
+# the time until every subscription was matched and notified
+import argparse
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from bench_subscriptions import drain_queue, make_subscriptions
+from common import bot, make_rows, publish_rows, report, summarize, use_temp_database
+from fakes import CountingBot, CountingBotFactory
+
+
+def write_subscriptions(subscriptions):
+    with closing(sqlite3.connect(bot.DATABASE)) as conn:
+        with conn:
+            conn.execute(bot.CREATE_SUBSCRIPTIONS)
+            conn.execute("DELETE FROM subscriptions")
+            conn.executemany(bot.INSERT_SUBSCRIPTION, [(subscription['id'], subscription['chat_id'],
+                subscription['name'], bot.json.dumps(subscription['command'], cls = bot.EnumEncoder),
+                subscription['last_id']) for subscription in subscriptions.values()])
+
+
+def run(shard_counts = (0, 1, 2, 4), subscription_count = 20000, hikes = 1000, repeat = 3):
+    directory = use_temp_database()
+    rows = make_rows(hikes)
+    bot.__snapshot__ = bot.HikesSnapshot(bot.HikeStore([]), dict(), 0, 0)
+    # Half of the hikes are known, the other half is new to every subscription
+    publish_rows(rows[:hikes // 2])
+    before = bot.__snapshot__
+    subscriptions = make_subscriptions(subscription_count, before.latest_id)
+    for subscription in subscriptions.values():
+        subscription['last_id'] = before.latest_id
+    write_subscriptions(subscriptions)
+    publish_rows(rows)
+    after = bot.__snapshot__
+    new_hikes = [hike for hike in after.store.hikes if hike.id > before.latest_id]
+    bot.__outbox__ = None
+    results = []
+    for shards in shard_counts:
+        timings = []
+        for _ in range(repeat):
+            drain_queue()
+            if shards == 0:
+                bot.__subscriptions__.replace(subscriptions)
+                bot.__subscriptions__.current_index()
+                fake = CountingBot()
+                start = time.perf_counter()
+                bot.notify_new_hikes(fake, new_hikes, after.latest_id)
+                timings.append(time.perf_counter() - start)
+                continue
+            workers = bot.NotificationShards(shards, CountingBotFactory(),
+                os.path.join(directory, 'hbm.snapshot'), send_rate = None)
+            workers.start()
+            try:
+                # Workers load their subscriptions and catch up with the known hikes first
+                workers.publish(before)
+                workers.wait_processed(before.generation, 120)
+                start = time.perf_counter()
+                workers.publish(after)
+                workers.wait_processed(after.generation, 120)
+                timings.append(time.perf_counter() - start)
+            finally:
+                workers.stop(10)
+        results.append(summarize('notify_shards', timings, shards = shards, subscriptions = subscription_count,
+            new_hikes = len(new_hikes), cpus = os.cpu_count()))
+    drain_queue()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark notification shards')
+    parser.add_argument('--shards', type = int, nargs = '+', default = [0, 1, 2, 4])
+    parser.add_argument('--subscriptions', type = int, default = 20000)
+    parser.add_argument('--hikes', type = int, default = 1000)
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+    report(run(args.shards, args.subscriptions, args.hikes, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Benchmark of the subscription notification tick and of persisting subscription updates, eg:
+#   python benchmarks/bench_subscriptions.py --subscriptions 100 10000 100000
+import argparse
+import random
+import time
+
+from common import bot, make_rows, measure, publish_rows, report, summarize, use_temp_database
+from fakes import CountingBot
+
+
+def make_subscriptions(count, latest_id, seed = 0):
+    rng = random.Random(seed)
+    texts = ['eventsall', 'eventsweek T1 T3', 'eventsweek T3 T5', 'eventsorganiser Organiser 1',
+             'eventsorganiser organiser 2']
+    subscriptions = dict()
+    for index in range(count):
+        text = rng.choice(texts).split()
+        subscription_id = 'sub%d' % index
+        subscriptions[subscription_id] = {
+            'id': subscription_id,
+            'chat_id': index,
+            'name': 'sub%d' % index,
+            'command': bot.parse_command(text[0], text[1:]),
+            # Half of the subscriptions have already seen every hike
+            'last_id': latest_id if index % 2 else rng.randint(0, latest_id)
+        }
+    return subscriptions
+
+
+def drain_queue():
+    while not bot.__subscription_queue__.empty():
+        bot.__subscription_queue__.get(block = False)
+
+
+def run(subscription_counts = (100, 10000, 100000), hikes = 2000, repeat = 5):
+    use_temp_database()
+    # Notifications go straight to the counting bot
+    bot.__outbox__ = None
+    publish_rows(make_rows(hikes))
+    latest_id = bot.__snapshot__.latest_id
+    results = []
+    for count in subscription_counts:
+        subscriptions = make_subscriptions(count, latest_id)
+        fake = CountingBot()
+
+        def reset():
+            bot.__subscriptions__.replace(subscriptions)
+            drain_queue()
+            fake.sent = 0
+        result = measure('send_subscriptions', lambda: bot.send_subscriptions(fake, None), repeat,
+            setup = reset, subscriptions = count, hikes = hikes)
+        result['messages'] = fake.sent
+        results.append(result)
+        # Once every subscription is up to date a tick has nothing to send
+        results.append(measure('send_subscriptions_idle', lambda: bot.send_subscriptions(fake, None), repeat,
+            subscriptions = count, hikes = hikes))
+
+        # The index is rebuilt only when subscriptions are added or removed, not on every fetch
+        def reset_indexed():
+            reset()
+            bot.__subscriptions__.current_index()
+
+        # The loader pushes only the hikes of a fetch through the subscription index
+        for new_count in (1, 10):
+            new_hikes = sorted(bot.__snapshot__.store.hikes, key = lambda hike: hike.id)[-new_count:]
+            result = measure('notify_new_hikes', lambda: bot.notify_new_hikes(fake, new_hikes, latest_id), repeat,
+                setup = reset_indexed, subscriptions = count, hikes = hikes, new_hikes = new_count)
+            result['messages'] = fake.sent
+            results.append(result)
+
+        handler = bot.SubscriptionHandler(10)
+        handler.setup()
+        timings = []
+        for iteration in range(repeat):
+            for subscription in subscriptions.values():
+                bot.__subscription_queue__.put(dict(subscription, action = 'add',
+                    id = '%s-%d' % (subscription['id'], iteration)))
+            start = time.perf_counter()
+            handler.task()
+            timings.append(time.perf_counter() - start)
+        handler.conn.close()
+        results.append(summarize('subscription_flush', timings, subscriptions = count))
+    drain_queue()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark subscription notifications')
+    parser.add_argument('--subscriptions', type = int, nargs = '+', default = [100, 10000, 100000])
+    parser.add_argument('--hikes', type = int, default = 2000)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+    report(run(args.subscriptions, args.hikes, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Shared helpers of the benchmark scripts: synthetic data, timing and reporting.
+# Every measurement is a flat JSON object so that runs can be diffed with compare.py
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bot
+
+
+# Events spread over the coming months at the usual start times, like the upstream list
+def make_rows(count, seed = 0, start = None):
+    rng = random.Random(seed)
+    organisers = ['Organiser %d' % i for i in range(max(1, count // 20))]
+    start = start or datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    rows = []
+    for hike_id in range(1, count + 1):
+        date = start + timedelta(days = rng.randint(0, 180), hours = rng.choice([6, 7, 8, 9, 18]),
+            minutes = rng.choice([0, 15, 30, 45]))
+        rows.append([
+            '',
+            'Hike number %d' % hike_id,
+            'T%d' % rng.randint(0, 6),
+            rng.choice(organisers),
+            '%d,%d,%d,%d,%d,%02d' % (date.weekday(), date.day, date.month, date.year, date.hour, date.minute),
+            str(hike_id)
+        ])
+    return rows
+
+
+def make_payload(rows):
+    return json.dumps({ 'draw': 5, 'recordsTotal': len(rows), 'recordsFiltered': len(rows),
+                        'data': rows }).encode('utf-8')
+
+
+# Publishes rows as the live hikes of the bot and returns the loader that parsed them
+def publish_rows(rows):
+    loader = bot.HikesLoader(30)
+    changes = loader.refresh(rows)
+    bot.publish_hikes([entry[1] for entry in loader.snapshot.values()], changes)
+    return loader
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name, timings, **params):
+    timings = sorted(timings)
+    result = dict(benchmark = name, repeat = len(timings),
+        best_ms = timings[0] * 1000 if timings else 0.0,
+        median_ms = percentile(timings, 0.5) * 1000,
+        p95_ms = percentile(timings, 0.95) * 1000,
+        mean_ms = sum(timings) / len(timings) * 1000 if timings else 0.0)
+    result.update(params)
+    return result
+
+
+# Times func repeat times. setup runs before every repetition and is not timed
+def measure(name, func, repeat = 5, setup = None, **params):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return summarize(name, timings, **params)
+
+
+def report(results, output = None):
+    lines = [json.dumps(result, sort_keys = True) for result in results]
+    for line in lines:
+        print(line)
+    if output:
+        with open(output, 'a') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+
+# Points the bot at a throwaway database so benchmarks never touch hbm.db
+def use_temp_database():
+    directory = tempfile.mkdtemp(prefix = 'hbm-bench-')
+    atexit.register(shutil.rmtree, directory, True)
+    bot.DATABASE = os.path.join(directory, 'hbm.db')
+    return directory
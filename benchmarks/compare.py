@@ -0,0 +1,61 @@
+# Compares two result files of run_all.py and exits non zero if a benchmark got slower by
+# more than the threshold, eg:
+#   python benchmarks/compare.py baseline.jsonl current.jsonl --threshold 0.2
+import argparse
+import json
+import sys
+
+IGNORED = set(['best_ms', 'median_ms', 'p95_ms', 'mean_ms', 'repeat', 'seconds', 'commands_per_second',
+               'answered', 'messages', 'matches', 'statuses', 'updates_per_second', 'cpus'])
+
+
+# Benchmarks are matched by their name and parameters
+def result_key(result):
+    return json.dumps(dict((name, value) for name, value in result.items() if name not in IGNORED),
+        sort_keys = True)
+
+
+# Slowdown as a fraction: positive is slower
+def slowdown(baseline, current):
+    if 'median_ms' in baseline and 'median_ms' in current:
+        if baseline['median_ms'] <= 0:
+            return 0.0
+        return current['median_ms'] / baseline['median_ms'] - 1
+    if 'commands_per_second' in baseline and 'commands_per_second' in current:
+        if current['commands_per_second'] <= 0:
+            return float('inf')
+        return baseline['commands_per_second'] / current['commands_per_second'] - 1
+    return 0.0
+
+
+def load(path):
+    with open(path) as fp:
+        return dict((result_key(result), result) for result in map(json.loads, fp) if result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compare two benchmark runs')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+        help = 'allowed slowdown as a fraction, 0.2 is 20%%')
+    args = parser.parse_args()
+    baseline = load(args.baseline)
+    current = load(args.current)
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        change = slowdown(baseline[key], current[key])
+        status = 'ok'
+        if change > args.threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        print('%-10s %+7.1f%%  %s' % (status, change * 100, key))
+    for key in sorted(set(baseline) ^ set(current)):
+        print('%-10s %8s  %s' % ('missing', '', key))
+    if regressions:
+        print('%d benchmark(s) slower than the %d%% threshold' % (regressions, args.threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# Local stand-ins for the hiking-buddies event list endpoint and the Telegram Bot API.
+# Both run a threaded HTTP server on an ephemeral localhost port
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+
+    def __init__(self, handler):
+        self.server = ThreadingServer(('127.0.0.1', 0), handler)
+        self.server.fake = self
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status = 200, headers = None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UpstreamHandler(QuietHandler):
+
+    def do_GET(self):
+        fake = self.server.fake
+        query = parse_qs(urlparse(self.path).query)
+        start = int(query.get('start', ['0'])[0])
+        length = int(query.get('length', ['100'])[0])
+        with fake.lock:
+            fake.requests += 1
+            rows = fake.rows
+            version = fake.version
+            failing = start in fake.failing_starts
+        if failing:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%d-%d-%d"' % (version, start, length)
+        if fake.etags and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        payload = { 'draw': 5, 'recordsTotal': len(rows), 'recordsFiltered': len(rows),
+                    'data': rows[start:start + length] }
+        self.send_json(payload, headers = { 'ETag': etag } if fake.etags else None)
+
+
+class FakeUpstream(FakeServer):
+
+    # Serves rows like the DataTables event_list endpoint, paginated by start and length.
+    # With etags every page carries an ETag that changes whenever set_rows is called. Pages
+    # starting at one of failing_starts are answered with an error
+    def __init__(self, rows, etags = False):
+        FakeServer.__init__(self, UpstreamHandler)
+        self.lock = threading.Lock()
+        self.rows = list(rows)
+        self.version = 0
+        self.etags = etags
+        self.requests = 0
+        self.failing_starts = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/routes/event_list/get_event_list/' % self.port
+
+    def set_rows(self, rows):
+        with self.lock:
+            self.rows = list(rows)
+            self.version += 1
+
+
+class TelegramHandler(QuietHandler):
+
+    def do_GET(self):
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def read_params(self):
+        params = dict((key, values[0]) for key, values in parse_qs(urlparse(self.path).query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body.decode('utf-8')))
+            else:
+                params.update((key, values[0]) for key, values in parse_qs(body.decode('utf-8')).items())
+        return params
+
+    def handle_method(self):
+        fake = self.server.fake
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        params = self.read_params()
+        handler = getattr(fake, 'api_' + method, None)
+        if handler is None:
+            result = True
+        else:
+            result = handler(params)
+        self.send_json({ 'ok': True, 'result': result })
+
+
+class FakeTelegram(FakeServer):
+
+    # Minimal Bot API: getUpdates long polls a queue filled by push_update, sent messages and
+    # inline answers are recorded with the time they arrived
+    def __init__(self):
+        FakeServer.__init__(self, TelegramHandler)
+        self.cond = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.messages = []
+        self.answers = []
+        self.webhook = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/bot' % self.port
+
+    def push_update(self, update):
+        with self.cond:
+            update = dict(update, update_id = self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update
+
+    def push_command(self, chat_id, text):
+        return self.push_update(command_update(0, chat_id, text))
+
+    # Waits until count messages were sent to chat_id and returns them
+    def wait_for_messages(self, chat_id, count = 1, timeout = 10):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                messages = [message for message in self.messages if message['chat_id'] == chat_id]
+                remaining = deadline - time.time()
+                if len(messages) >= count or remaining <= 0:
+                    return messages
+                self.cond.wait(remaining)
+
+    def api_getMe(self, params):
+        return { 'id': 1, 'is_bot': True, 'first_name': 'HBM', 'username': 'HikingBuddiesBot' }
+
+    def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                updates = [update for update in self.updates if update['update_id'] >= offset]
+                remaining = deadline - time.time()
+                if updates or remaining <= 0:
+                    # Updates before the offset are confirmed and can be forgotten
+                    self.updates = updates
+                    return updates[:int(params.get('limit') or 100)]
+                self.cond.wait(remaining)
+
+    def api_sendMessage(self, params):
+        with self.cond:
+            message = { 'chat_id': int(params['chat_id']), 'text': params.get('text', ''),
+                        'time': time.time() }
+            self.messages.append(message)
+            self.cond.notify_all()
+            message_id = len(self.messages)
+        return { 'message_id': message_id, 'date': int(time.time()),
+                 'chat': { 'id': int(params['chat_id']), 'type': 'private' }, 'text': params.get('text', '') }
+
+    def api_answerInlineQuery(self, params):
+        with self.cond:
+            self.answers.append(dict(params, time = time.time()))
+            self.cond.notify_all()
+        return True
+
+    def api_setWebhook(self, params):
+        self.webhook = params
+        return True
+
+    def api_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+
+def command_update(update_id, chat_id, text):
+    command = text.split()[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': { 'id': chat_id, 'type': 'private' },
+            'from': { 'id': chat_id, 'is_bot': False, 'first_name': 'Hiker' },
+            'text': text,
+            'entities': [{ 'type': 'bot_command', 'offset': 0, 'length': len(command) }]
+        }
+    }
+
+
+# Stands in for the Bot of a notification worker and only counts messages. Workers are
+# spawned processes, so the factory lives in an importable module
+class CountingBot(object):
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+class CountingBotFactory(object):
+
+    def __call__(self):
+        return CountingBot()
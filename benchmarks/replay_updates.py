@@ -0,0 +1,131 @@
+# Replays recorded Telegram updates against the webhook listener of the bot, eg:
+#   python benchmarks/replay_updates.py --generate 1000 --output updates.jsonl
+#   python benchmarks/replay_updates.py --input updates.jsonl --url http://127.0.0.1:8443/ --secret <secret>
+#   python benchmarks/replay_updates.py --input updates.jsonl --local
+# Against a running bot only the time until an update is acknowledged is measured. --local
+# starts the webhook in process with fake Telegram and upstream servers and also measures the
+# time until the reply to every command was sent
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from telegram.ext import Updater
+
+from common import bot, make_rows, report, summarize, use_temp_database
+from fakes import FakeTelegram, FakeUpstream, command_update
+
+COMMANDS = ['/eventsall', '/eventsweek', '/eventsweek T2 T4', '/eventsorganiser organiser 1',
+            '/eventsdate - - sat,sun', '/help']
+
+
+def generate(count, seed = 0):
+    rng = random.Random(seed)
+    return [command_update(update_id, rng.randint(1, 100), rng.choice(COMMANDS))
+        for update_id in range(1, count + 1)]
+
+
+def load(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+# Posts every update and returns (status, seconds until acknowledged, time posted) per update
+def replay(updates, url, secret, concurrency = 8):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = concurrency, pool_maxsize = concurrency)
+    session.mount('http://', adapter)
+    headers = { 'X-Telegram-Bot-Api-Secret-Token': secret, 'Content-Type': 'application/json' }
+
+    def post(update):
+        posted = time.time()
+        start = time.perf_counter()
+        status = session.post(url, data = json.dumps(update), headers = headers, timeout = 10).status_code
+        return status, time.perf_counter() - start, posted
+    with ThreadPoolExecutor(max_workers = concurrency) as pool:
+        return list(pool.map(post, updates))
+
+
+def ack_results(name, responses, elapsed, **params):
+    statuses = dict()
+    for status, seconds, posted in responses:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    result = summarize(name, [seconds for status, seconds, posted in responses], **params)
+    result.update(statuses = statuses, updates_per_second = len(responses) / elapsed if elapsed else 0.0)
+    return result
+
+
+def run_remote(updates, url, secret, concurrency = 8):
+    start = time.perf_counter()
+    responses = replay(updates, url, secret, concurrency)
+    return [ack_results('webhook_ack', responses, time.perf_counter() - start, updates = len(updates),
+        concurrency = concurrency)]
+
+
+def run_local(updates = None, hikes = 1000, concurrency = 8, max_pending = bot.WEBHOOK_MAX_PENDING):
+    updates = updates or generate(200)
+    use_temp_database()
+    upstream = FakeUpstream(make_rows(hikes), etags = True).start()
+    telegram = FakeTelegram().start()
+    bot.EVENT_LIST_URL = upstream.url
+    bot.__outbox__ = None
+    updater = Updater(token = '123456:BENCHMARK', base_url = telegram.base_url)
+    bot.add_handlers(updater.dispatcher)
+    bot.HikesLoader(30).task()
+    webhook = bot.WebhookServer(updater.bot, updater.dispatcher, 0, path = '/webhook',
+        max_pending = max_pending)
+    webhook.start()
+    # Every update gets a chat of its own so that its reply can be told apart
+    updates = [dict(update, message = dict(update['message'], chat = dict(update['message']['chat'],
+        id = 1000000 + index))) for index, update in enumerate(updates)]
+    url = 'http://127.0.0.1:%d/webhook' % webhook.server.server_address[1]
+    try:
+        start = time.perf_counter()
+        responses = replay(updates, url, webhook.secret, concurrency)
+        accepted = [(update, posted) for update, (status, seconds, posted) in zip(updates, responses)
+            if status == 200]
+        latencies = []
+        for update, posted in accepted:
+            messages = telegram.wait_for_messages(update['message']['chat']['id'])
+            if messages:
+                latencies.append(messages[0]['time'] - posted)
+        elapsed = time.perf_counter() - start
+        params = dict(updates = len(updates), hikes = hikes, concurrency = concurrency, max_pending = max_pending)
+        results = [ack_results('webhook_ack', responses, elapsed, **params)]
+        result = summarize('webhook_command_latency', latencies, **params)
+        result.update(answered = len(latencies), commands_per_second = len(latencies) / elapsed if elapsed else 0.0)
+        results.append(result)
+        rejected = replay([updates[0]], url, 'wrong secret')
+        results.append(dict(benchmark = 'webhook_wrong_secret', status = rejected[0][0]))
+    finally:
+        webhook.stop()
+        upstream.stop()
+        telegram.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay Telegram updates against the webhook')
+    parser.add_argument('--input', help = 'JSON lines file of recorded updates')
+    parser.add_argument('--generate', type = int, help = 'generate this many command updates')
+    parser.add_argument('--output', help = 'write the generated updates to this file instead of replaying them')
+    parser.add_argument('--url', help = 'webhook url of a running bot')
+    parser.add_argument('--secret', default = '', help = 'secret token of the running bot')
+    parser.add_argument('--local', action = 'store_true', help = 'replay against an in process webhook')
+    parser.add_argument('--hikes', type = int, default = 1000)
+    parser.add_argument('--concurrency', type = int, default = 8)
+    args = parser.parse_args()
+    updates = load(args.input) if args.input else generate(args.generate or 200)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(''.join(json.dumps(update) + '\n' for update in updates))
+    elif args.url:
+        report(run_remote(updates, args.url, args.secret, args.concurrency))
+    else:
+        report(run_local(updates, args.hikes, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Runs every benchmark and writes the results as JSON lines, eg:
+#   python benchmarks/run_all.py --output baseline.jsonl
+#   python benchmarks/run_all.py --quick --output current.jsonl
+#   python benchmarks/compare.py baseline.jsonl current.jsonl
+import argparse
+import os
+
+import bench_archive
+import bench_e2e
+import bench_fetch
+import bench_parser
+import bench_queries
+import bench_shards
+import bench_subscriptions
+import replay_updates
+from common import report
+
+QUICK = {
+    'parser': dict(rows_count = 2000, repeat = 3),
+    'fetch': dict(row_counts = (1000,), page_sizes = (100,), repeat = 3),
+    'queries': dict(hike_counts = (1000, 10000), repeat = 10),
+    'subscriptions': dict(subscription_counts = (100, 1000), hikes = 1000, repeat = 3),
+    'e2e': dict(hikes = 1000, commands = 50, chats = 10),
+    'webhook': dict(hikes = 500),
+    'shards': dict(shard_counts = (0, 2), subscription_count = 2000, hikes = 200, repeat = 2),
+    'archive': dict(years = (1,), hikes_per_month = 100, repeat = 3),
+}
+FULL = {
+    'parser': dict(),
+    'fetch': dict(),
+    'queries': dict(),
+    'subscriptions': dict(),
+    'e2e': dict(),
+    'webhook': dict(),
+    'shards': dict(),
+    'archive': dict(),
+}
+SUITES = [
+    ('parser', bench_parser.run),
+    ('fetch', bench_fetch.run),
+    ('queries', bench_queries.run),
+    ('subscriptions', bench_subscriptions.run),
+    ('e2e', bench_e2e.run),
+    ('webhook', replay_updates.run_local),
+    ('shards', bench_shards.run),
+    ('archive', bench_archive.run),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run every benchmark')
+    parser.add_argument('--quick', action = 'store_true', help = 'smaller inputs for a quick check')
+    parser.add_argument('--only', nargs = '+', choices = [name for name, run in SUITES])
+    parser.add_argument('--output', help = 'file the JSON lines are written to')
+    args = parser.parse_args()
+    if args.output and os.path.exists(args.output):
+        os.remove(args.output)
+    settings = QUICK if args.quick else FULL
+    for name, run in SUITES:
+        if args.only and name not in args.only:
+            continue
+        results = run(**settings[name])
+        for result in results:
+            result['suite'] = name
+        report(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,48 @@
 from telegram.ext import Updater, CommandHandler, MessageHandler, InlineQueryHandler, Filters
-from telegram import InlineQueryResultArticle, InputTextMessageContent, ParseMode
+from telegram import Bot, InlineQueryResultArticle, InputTextMessageContent, ParseMode, Update
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, Unauthorized
 import os
 import logging
 import signal
 import sys
 import time
+import random
 import threading
 import requests
 import calendar
 from datetime import datetime, timedelta
 from threading import Thread
+from contextlib import closing
+from functools import lru_cache
 import sqlite3
 from queue import Queue
 import queue
 import json
+import re
+import importlib
+import asyncio
+import hashlib
+import hmac
+import secrets
+import bisect
+import mmap
+import multiprocessing
+import struct
+import heapq
+import itertools
+import unicodedata
+from collections import namedtuple, deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from array import array
 from enum import Enum
+# Optional streaming JSON decoder
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 ## Enums
 class Difficulty(Enum):
@@ -28,19 +56,135 @@ class Difficulty(Enum):
 
 ## Constants
 DAYS = list(calendar.day_name)
+DIFFICULTIES = dict((difficulty.name, difficulty) for difficulty in Difficulty)
+# Upstream dates are weekday,day,month,year,hour,minute
+DATE_PATTERN = re.compile(r'^\d,\d{1,2},\d{1,2},\d{4},\d{1,2},\d{1,2}$')
+DATE_CACHE_SIZE = 4096
+# Oldest year accepted in commands, and days a start date without a year may lie in the past
+# before it is taken to mean next year
+MIN_YEAR = 1900
+PAST_START_DAYS = 31
+# JSON modules tried in order when decoding upstream payloads. HBM_JSON_BACKEND forces one
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
 PUBLIC_ENUMS = {
     'Difficulty': Difficulty
 }
 
+EVENT_LIST_URL = os.environ.get('HBM_EVENT_LIST_URL',
+    'https://www.hiking-buddies.com/routes/event_list/get_event_list/')
+# Number of events requested per page of the event list
+PAGE_SIZE = int(os.environ.get('HBM_PAGE_SIZE', 100))
+FETCH_WORKERS = 4
+FETCH_TIMEOUT = 30
+# 'threads' runs every job on its own thread, 'async' runs them on one asyncio event loop
+RUNTIME = os.environ.get('HBM_RUNTIME', 'threads')
+# Base url of the Telegram Bot API. Can point to a fake API server for local testing
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+# Long polling timeout for getUpdates in the async runtime
+UPDATES_POLL_TIMEOUT = 5
+# Telegram limits: characters per message, messages per second overall and per chat
+MESSAGE_LIMIT = 4096
+GLOBAL_SEND_RATE = 25
+CHAT_SEND_RATE = 1
+# Per chat rate limits kept by the outbound queue before those that are full again are dropped
+CHAT_BUCKETS_SWEEP = 1024
+# Port of the local metrics and profiling endpoint. Disabled when not set
+METRICS_PORT = os.environ.get('HBM_METRICS_PORT')
+# Seconds between two stack samples of the profiler
+PROFILE_INTERVAL = 0.01
+# 'polling' asks Telegram for updates, 'webhook' has Telegram post them to HBM_WEBHOOK_URL. The
+# url has to reach the listener on HBM_WEBHOOK_HOST:HBM_WEBHOOK_PORT, eg: through a reverse proxy
+UPDATES_MODE = os.environ.get('HBM_UPDATES', 'polling')
+WEBHOOK_URL = os.environ.get('HBM_WEBHOOK_URL')
+WEBHOOK_HOST = os.environ.get('HBM_WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('HBM_WEBHOOK_PORT', 8443))
+# Telegram sends it with every update. A random one is used for each run when not set
+WEBHOOK_SECRET = os.environ.get('HBM_WEBHOOK_SECRET')
+WEBHOOK_WORKERS = 8
+# Updates waiting or being handled before new ones are turned away
+WEBHOOK_MAX_PENDING = 256
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_MAX_BODY = 1 << 20
+# Number of worker processes that match and send subscription notifications. With 0 this
+# process does it. Workers read the published hikes from SNAPSHOT_FILE
+NOTIFY_SHARDS = int(os.environ.get('HBM_NOTIFY_SHARDS', 0))
+SNAPSHOT_FILE = 'hbm.snapshot'
+# Seconds a worker waits for a wake up before it checks for changes anyway
+SHARD_POLL_INTERVAL = 1
+# Snapshot file: magic, generation, latest hike id and number of hikes, followed by the hikes.
+# Every hike is a record of id, timestamp, difficulty value and the byte lengths of the name
+# and organiser that follow it
+SNAPSHOT_MAGIC = b'HBM1'
+SNAPSHOT_HEADER = struct.Struct('<4sqqI')
+HIKE_RECORD = struct.Struct('<qqbHH')
+EPOCH = datetime(1970, 1, 1)
+# Archive of every hike ever published: one append-only file of hike records per month of the
+# hike date, next to an index of the latest record of every hike by organiser and difficulty.
+# A record with difficulty ARCHIVE_REMOVED marks a hike that moved to another month. Only kept
+# when HBM_ARCHIVE_DIR is set
+ARCHIVE_DIR = os.environ.get('HBM_ARCHIVE_DIR')
+ARCHIVE_PARTITION = re.compile(r'^(\d{4}-\d{2})\.dat$')
+ARCHIVE_REMOVED = -1
+# Most hikes listed by /historyorganiser and months shown by default by /historymonths
+ARCHIVE_HISTORY_LIMIT = 100
+ARCHIVE_DEFAULT_MONTHS = 12
+
+DATABASE = 'hbm.db'
+# sqlite keeps these statements prepared in the per connection statement cache
+CREATE_SUBSCRIPTIONS = "CREATE TABLE IF NOT EXISTS subscriptions (id TEXT PRIMARY KEY, " \
+    "chat_id INT, name TEXT, command TEXT, last_id INT)"
+CREATE_SUBSCRIPTIONS_INDEX = "CREATE INDEX IF NOT EXISTS subscriptions_chat_name " \
+    "ON subscriptions (chat_id, name)"
+INSERT_SUBSCRIPTION = "REPLACE INTO subscriptions VALUES (?, ?, ?, ?, ?)"
+DELETE_SUBSCRIPTION = "DELETE FROM subscriptions WHERE chat_id = ? AND name = ?"
+ADVANCE_SUBSCRIPTION = "UPDATE subscriptions SET last_id = ? WHERE id = ? AND last_id < ?"
+# Subscriptions of one notification shard. abs() puts the negative ids of groups on a shard too
+SELECT_SHARD_SUBSCRIPTIONS = "SELECT * FROM subscriptions WHERE abs(chat_id) % ? = ?"
+# Last parsed hikes as raw upstream rows, and values such as the latest hike id
+CREATE_HIKES = "CREATE TABLE IF NOT EXISTS hikes (id TEXT PRIMARY KEY, row TEXT)"
+CREATE_STATE = "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INT)"
+SELECT_HIKES = "SELECT row FROM hikes"
+INSERT_HIKE = "REPLACE INTO hikes VALUES (?, ?)"
+DELETE_HIKE = "DELETE FROM hikes WHERE id = ?"
+DELETE_HIKES = "DELETE FROM hikes"
+SELECT_STATE = "SELECT value FROM state WHERE key = ?"
+INSERT_STATE = "REPLACE INTO state VALUES (?, ?)"
+# Total number of hikes held by the query cache before least recently used entries are evicted
+QUERY_CACHE_WEIGHT = 50000
+# Inline queries: most results Telegram accepts, seconds clients may cache an answer, share of
+# the trigrams of a query a hike must have, and the characters that separate words
+INLINE_RESULTS_LIMIT = 50
+INLINE_CACHE_TIME = 30
+SEARCH_MIN_SIMILARITY = 0.5
+SEARCH_CACHE_SIZE = 16384
+SEARCH_SEPARATORS = re.compile(r'[\W_]+')
+
 ## Global shared variables
-__hikes_data__ = []
-__latest_hike_id__ = 0
+# The published hikes (__snapshot__) and subscriptions (__subscriptions__) are set up after the
+# class definitions
 __subscription_queue__ = Queue()
-__subscriptions__ = dict()
+__http_session__ = None
+__fetch_pool__ = None
+__outbox__ = None
+__query_cache__ = None
+__json_loads__ = None
+__metrics_server__ = None
+__webhook_server__ = None
+__shards__ = None
+__archive__ = None
+# Held while subscriptions are matched and notified so a hike is never sent twice
+__notify_lock__ = threading.Lock()
 
 
 ## Class Definitions
 
+# Hikes added, updated and removed by one refresh of the HikesLoader
+HikesChangeset = namedtuple('HikesChangeset', ['added', 'updated', 'removed'])
+# Everything published by one refresh: the HikeStore, the rendered line of every hike by id,
+# the latest hike id seen and the data generation, which is bumped on every refresh
+HikesSnapshot = namedtuple('HikesSnapshot', ['store', 'lines', 'latest_id', 'generation'])
+
+
 class EnumEncoder(json.JSONEncoder):
     def default(self, obj):
         if type(obj) in PUBLIC_ENUMS.values():
@@ -48,18 +192,79 @@ class EnumEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class Scheduler(object):
+
+    # Runs a Job on a fixed interval
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_delay(self):
+        return self.interval
+
+    # Called after a run that checked for changes
+    def observe(self, changed):
+        pass
+
+    # Called after a run that failed
+    def failed(self):
+        pass
+
+
+class AdaptiveScheduler(Scheduler):
+
+    # Tightens the interval when changes are observed and relaxes it while nothing changes.
+    # Night hours are polled at the slowest rate and failures back off exponentially.
+    # Every delay is jittered so that restarts do not synchronise polling
+    def __init__(self, interval, min_interval = None, max_interval = None, jitter = 0.1,
+            night_hours = (1, 6), max_backoff = 600):
+        Scheduler.__init__(self, interval)
+        self.min_interval = min_interval or interval / 3.0
+        self.max_interval = max_interval or interval * 10
+        self.jitter = jitter
+        self.night_hours = night_hours
+        self.max_backoff = max_backoff
+        self.current = interval
+        self.failures = 0
+
+    def next_delay(self, now = None):
+        now = now or datetime.now()
+        if self.failures > 0:
+            delay = min(self.max_backoff, self.interval * 2 ** self.failures)
+        elif self.night_hours[0] <= now.hour < self.night_hours[1]:
+            delay = self.max_interval
+        else:
+            delay = self.current
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def observe(self, changed):
+        self.failures = 0
+        if changed:
+            self.current = max(self.min_interval, self.current / 2.0)
+        else:
+            self.current = min(self.max_interval, self.current * 1.5)
+
+    def failed(self):
+        self.failures += 1
+
+
 class Job(threading.Thread):
     
     #
     # task_callback is the task to be executed by the job
     # sleep_seconds the number of seconds to sleep before executing the task again
-    def __init__(self, sleep_seconds):
+    # scheduler decides the delay between runs. Defaults to a fixed sleep_seconds
+    def __init__(self, sleep_seconds, scheduler = None):
         threading.Thread.__init__(self)
         
         # The shutdown_flag is a threading.Event object that
         # indicates whether the thread should be terminated.
         self.shutdown_flag = threading.Event()
+        # The wake_flag interrupts the wait between runs. Runtimes that do not wait on it, such
+        # as the AsyncRuntime, register a callback in wake_callbacks instead
+        self.wake_flag = threading.Event()
+        self.wake_callbacks = []
         self.sleep_seconds = sleep_seconds
+        self.scheduler = scheduler or Scheduler(sleep_seconds)
  
     def run(self):
         logging.info('Thread #%s started' % self.ident)
@@ -68,13 +273,28 @@ class Job(threading.Thread):
         self.setup()
 
         while not self.shutdown_flag.is_set():
-            self.task()
-            time.sleep(self.sleep_seconds)
+            try:
+                self.task()
+            except Exception:
+                logging.exception('Task failed in thread #%s' % self.ident)
+                self.scheduler.failed()
+            self.wake_flag.wait(self.scheduler.next_delay())
+            self.wake_flag.clear()
  
         # Thread cleanup code
         self.cleanup()
         logging.info('Thread #%s stopped' % self.ident)
 
+    # Runs the task again without waiting for the rest of the delay
+    def refresh_now(self):
+        self.wake_flag.set()
+        for callback in self.wake_callbacks:
+            callback()
+
+    def stop(self):
+        self.shutdown_flag.set()
+        self.wake_flag.set()
+
     def setup(self):
         pass
 
@@ -85,91 +305,1585 @@ class Job(threading.Thread):
         pass
 
 
+class SubscriptionRegistry(object):
+
+    # Copy-on-write map of subscriptions by id. current() returns a dict that is never changed
+    # once published, so readers can iterate it without locks while writers build a new dict
+    # and swap it in
+    def __init__(self, subscriptions = None):
+        self.subscriptions = dict(subscriptions or {})
+        self.lock = threading.Lock()
+        # Changes whenever subscriptions are added or removed but not when they advance, so
+        # that the SubscriptionIndex is only rebuilt when the set of commands changed
+        self.version = 0
+        self.index = None
+        self.index_version = None
+
+    def current(self):
+        return self.subscriptions
+
+    def replace(self, subscriptions):
+        with self.lock:
+            self.subscriptions = dict(subscriptions)
+            self.version += 1
+
+    def update(self, added = (), removed = ()):
+        with self.lock:
+            subscriptions = dict(self.subscriptions)
+            for subscription_id in removed:
+                subscriptions.pop(subscription_id, None)
+            for subscription in added:
+                subscriptions[subscription['id']] = subscription
+            self.subscriptions = subscriptions
+            self.version += 1
+
+    # Moves last_id of subscriptions forward. Subscription records are replaced, not changed
+    def advance(self, last_ids):
+        with self.lock:
+            subscriptions = dict(self.subscriptions)
+            for subscription_id, last_id in last_ids.items():
+                subscription = subscriptions.get(subscription_id)
+                if subscription is not None and subscription['last_id'] < last_id:
+                    subscriptions[subscription_id] = dict(subscription, last_id = last_id)
+            self.subscriptions = subscriptions
+
+    # The reverse index of the current subscriptions, rebuilt after they were added or removed
+    def current_index(self):
+        with self.lock:
+            version = self.version
+            subscriptions = self.subscriptions
+            index = self.index
+            if index is not None and self.index_version == version:
+                return index
+        index = SubscriptionIndex(subscriptions.values())
+        with self.lock:
+            if self.version == version:
+                self.index = index
+                self.index_version = version
+        return index
+
+
 class SubscriptionHandler(Job):
 
+    # With a bot, subscriptions are caught up with the published hikes right after they were
+    # added, since new hikes published while they were queued were not matched against them
+    def __init__(self, sleep_seconds, scheduler = None, bot = None):
+        Job.__init__(self, sleep_seconds, scheduler)
+        self.bot = bot
+        # Coalesced updates that were not written yet, kept when a flush fails
+        self.pending = self.empty_pending()
+
     def setup(self):
-        global __subscriptions__
-        self.conn = sqlite3.connect('hbm.db')
+        self.conn = sqlite3.connect(DATABASE)
         c = self.conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS subscriptions (id TEXT PRIMARY KEY, " \
-            "chat_id INT, name TEXT, command TEXT, last_id INT)")
+        # WAL lets readers carry on while a flush is being written and makes commits cheaper
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+        c.execute(CREATE_SUBSCRIPTIONS)
+        c.execute(CREATE_SUBSCRIPTIONS_INDEX)
+        c.execute(CREATE_STATE)
         self.conn.commit()
         c.execute("SELECT * FROM subscriptions")
         results = c.fetchall()
         subs = dict()
         for result in results:
-            subs[result[0]] = {
-                'id': result[0],
-                'chat_id': result[1],
-                'name': result[2],
-                'command': json.loads(result[3], object_hook = as_enum),
-                'last_id': result[4]
-            }
-        __subscriptions__ = subs
+            subs[result[0]] = subscription_from_row(result)
+        __subscriptions__.replace(subs)
+
+    @staticmethod
+    def empty_pending():
+        return { 'adds': dict(), 'removes': dict(), 'advances': dict(), 'notified': None }
 
+    # Drains the queue and writes everything in one transaction. Updates are coalesced per
+    # subscription id so that only the last state of every subscription is written. When the
+    # transaction fails the updates are kept and merged with the ones of the next flush
     def task(self):
-        global __subscriptions__
-        logging.info("running task")
+        logging.debug("running task")
+        adds = self.pending['adds']
+        removes = self.pending['removes']
+        advances = self.pending['advances']
+        notified = self.pending['notified']
         again = True
-        c = self.conn.cursor()
         while again:
             try:
                 subscription = __subscription_queue__.get(block = False)
                 action = subscription.pop('action', None)
                 if action == 'add':
-                    c.execute("REPLACE INTO subscriptions VALUES (?, ?, ?, ?, ?)", 
-                        (subscription['id'], subscription['chat_id'], subscription['name'], 
-                            json.dumps(subscription['command'], cls = EnumEncoder), subscription['last_id']))
-                    __subscriptions__[subscription['id']] = subscription
+                    adds[subscription['id']] = subscription
+                    removes.pop(subscription['id'], None)
+                    advances.pop(subscription['id'], None)
                 elif action == 'remove':
-                    c.execute("DELETE FROM subscriptions WHERE name = ? AND chat_id = ?",
-                        (subscription['name'], subscription['chat_id']))
-                    __subscriptions__.pop(subscription['id'], None)
+                    removes[subscription['id']] = subscription
+                    adds.pop(subscription['id'], None)
+                    advances.pop(subscription['id'], None)
+                elif action == 'advance':
+                    if subscription['id'] in adds:
+                        added = adds[subscription['id']]
+                        added['last_id'] = max(added['last_id'], subscription['last_id'])
+                    elif subscription['id'] not in removes:
+                        advances[subscription['id']] = max(advances.get(subscription['id'], 0),
+                            subscription['last_id'])
+                elif action == 'notified':
+                    notified = max(notified or 0, subscription['last_id'])
                 else:
-                    log.error("Unknown action while pulling from subscription queue: %s" % action)
+                    logging.error("Unknown action while pulling from subscription queue: %s" % action)
                 # Keep emptying until nothing is found
                 again = True
             except queue.Empty as e:
                 again = False
                 pass
-        self.conn.commit()
-        logging.info("task completed")
+        if adds or removes or advances or notified is not None:
+            start = time.perf_counter()
+            try:
+                with self.conn:
+                    self.conn.executemany(DELETE_SUBSCRIPTION,
+                        [(subscription['chat_id'], subscription['name']) for subscription in removes.values()])
+                    self.conn.executemany(INSERT_SUBSCRIPTION,
+                        [(subscription['id'], subscription['chat_id'], subscription['name'],
+                            json.dumps(subscription['command'], cls = EnumEncoder), subscription['last_id'])
+                            for subscription in adds.values()])
+                    self.conn.executemany(ADVANCE_SUBSCRIPTION,
+                        [(last_id, subscription_id, last_id) for subscription_id, last_id in advances.items()])
+                    if notified is not None:
+                        self.conn.execute(INSERT_STATE, ('notified_id', notified))
+            except sqlite3.Error:
+                logging.exception("Saving subscription updates failed")
+                self.pending['notified'] = notified
+                return
+            self.pending = self.empty_pending()
+            __subscriptions__.update(adds.values(), removes.keys())
+            if __shards__ is not None and (adds or removes):
+                __shards__.subscriptions_changed()
+            FLUSH_SECONDS.observe(time.perf_counter() - start)
+            FLUSHED_UPDATES.inc(len(adds), labels = ('add',))
+            FLUSHED_UPDATES.inc(len(removes), labels = ('remove',))
+            FLUSHED_UPDATES.inc(len(advances), labels = ('advance',))
+            # Notification shards catch up their own subscriptions when they reload them
+            if adds and self.bot is not None and __shards__ is None:
+                notify_pending_hikes(self.bot, adds.keys())
+        logging.debug("task completed")
 
     def cleanup(self):
         self.task()
         self.conn.close()
 
 
+class AsyncRuntime(object):
+
+    # Runs the hikes fetcher, the subscription persister, a one time subscription catch up and update
+    # handling as coroutines on one event loop instead of a thread per job. Blocking calls
+    # (requests, the Telegram bot) go to a shared executor so they never stall the loop, and
+    # sqlite stays on a single dedicated thread because connections are bound to their thread
+    # Without poll, updates come in through the WebhookServer instead
+    def __init__(self, bot, dispatcher, loader, persister, catch_up_delay = 15, workers = 8, poll = True):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.poll = poll
+        self.loader = loader
+        self.persister = persister
+        self.catch_up_delay = catch_up_delay
+        self.io_pool = ThreadPoolExecutor(max_workers = workers)
+        self.db_pool = ThreadPoolExecutor(max_workers = 1)
+        self.pending = set()
+        self.loop = None
+        self.stopping = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+            self.io_pool.shutdown(wait = True)
+            self.db_pool.shutdown(wait = True)
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def main(self):
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Not available outside the main thread or on every platform
+                pass
+        await self.in_db(self.persister.setup)
+        await asyncio.gather(self.fetch_hikes(), self.persist_subscriptions(),
+            self.catch_up_subscriptions(), self.poll_updates())
+        # Let handlers that are still running finish, then flush subscriptions one last time
+        if self.pending:
+            await asyncio.wait(self.pending)
+        await self.in_db(self.persister.cleanup)
+        logging.info("Async runtime stopped")
+
+    def in_io(self, func, *args):
+        return self.loop.run_in_executor(self.io_pool, func, *args)
+
+    def in_db(self, func, *args):
+        return self.loop.run_in_executor(self.db_pool, func, *args)
+
+    # Sleeps for delay seconds or until the runtime is stopped, or wake is set
+    async def sleep(self, delay, wake = None):
+        waits = [asyncio.ensure_future(self.stopping.wait())]
+        if wake is not None:
+            waits.append(asyncio.ensure_future(wake.wait()))
+        done, pending = await asyncio.wait(waits, timeout = delay, return_when = asyncio.FIRST_COMPLETED)
+        for future in pending:
+            future.cancel()
+
+    # Runs the task of job on the schedule of the job. Job.refresh_now ends the wait between
+    # runs as it does for a threaded job
+    async def repeat(self, name, run, job):
+        wake = asyncio.Event()
+        callback = lambda: self.loop.call_soon_threadsafe(wake.set)
+        job.wake_callbacks.append(callback)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    await run()
+                except Exception:
+                    logging.exception('%s failed' % name)
+                    job.scheduler.failed()
+                await self.sleep(job.scheduler.next_delay(), wake)
+                wake.clear()
+                job.wake_flag.clear()
+        finally:
+            job.wake_callbacks.remove(callback)
+
+    async def fetch_hikes(self):
+        await self.repeat('Hikes fetch', lambda: self.in_io(self.loader.task), self.loader)
+
+    async def persist_subscriptions(self):
+        await self.repeat('Subscription flush', lambda: self.in_db(self.persister.task), self.persister)
+
+    # Subscriptions are caught up once. After that the loader notifies them of new hikes
+    async def catch_up_subscriptions(self):
+        await self.sleep(self.catch_up_delay)
+        if self.stopping.is_set():
+            return
+        try:
+            await self.in_io(send_subscriptions, self.bot, None)
+        except Exception:
+            logging.exception('Subscription catch up failed')
+
+    async def poll_updates(self):
+        offset = None
+        while self.poll and not self.stopping.is_set():
+            try:
+                updates = await self.in_io(lambda: self.bot.get_updates(offset = offset,
+                    timeout = UPDATES_POLL_TIMEOUT))
+            except Exception:
+                logging.exception('Polling updates failed')
+                await self.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                future = self.in_io(self.dispatcher.process_update, update)
+                self.pending.add(future)
+                future.add_done_callback(self.pending.discard)
+
+
+class TokenBucket(object):
+
+    # Allows rate events per second on average with bursts of up to capacity events
+    def __init__(self, rate, capacity = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes a token and returns the number of seconds to wait before using it
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # A full bucket allows the same as a new one
+    def full(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class OutboundQueue(object):
+
+    # Delivers notifications on a pool of worker threads so that a slow or failing chat does
+    # not hold up the others. Sends respect a global and a per chat rate limit, flood waits
+    # and network errors are retried with backoff, and messages waiting for the same chat
+    # are coalesced into as few messages as possible
+    def __init__(self, bot, workers = 4, global_rate = GLOBAL_SEND_RATE, chat_rate = CHAT_SEND_RATE,
+            max_retries = 5):
+        self.bot = bot
+        self.workers = [Thread(target = self.work) for _ in range(workers)]
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        # Guarded by cond. Swept once it grows past sweep_size, so it holds the chats that were
+        # sent to recently rather than every chat ever notified
+        self.chat_buckets = dict()
+        self.sweep_size = CHAT_BUCKETS_SWEEP
+        self.max_retries = max_retries
+        self.cond = threading.Condition()
+        # Messages waiting per chat as (text, enqueue time), chats ready to be picked up in
+        # FIFO order and chats currently owned by a worker, which keeps each chat in order
+        self.pending = dict()
+        self.ready = deque()
+        self.busy = set()
+        self.stopping = False
+        self.shutdown_flag = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    # Sends what is already queued, without waiting for retries, and stops the workers
+    def stop(self, timeout = None):
+        self.shutdown_flag.set()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def put(self, chat_id, text):
+        with self.cond:
+            if chat_id not in self.pending:
+                self.pending[chat_id] = []
+                if chat_id not in self.busy:
+                    self.ready.append(chat_id)
+            self.pending[chat_id].append((text, time.time()))
+            self.cond.notify()
+
+    def depth(self):
+        with self.cond:
+            return sum(len(messages) for messages in self.pending.values())
+
+    def stats(self):
+        with self.cond:
+            depth = sum(len(messages) for messages in self.pending.values())
+            return { 'depth': depth, 'sent': self.sent, 'failed': self.failed, 'retried': self.retried,
+                     'latency_avg': self.latency_total / self.sent if self.sent else 0.0,
+                     'latency_max': self.latency_max }
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.stopping:
+                    self.cond.wait()
+                if not self.ready:
+                    return
+                chat_id = self.ready.popleft()
+                messages = self.pending.pop(chat_id)
+                self.busy.add(chat_id)
+            try:
+                self.deliver(chat_id, messages)
+            except Exception:
+                logging.exception('Delivering to chat %s failed' % chat_id)
+            with self.cond:
+                self.busy.discard(chat_id)
+                if chat_id in self.pending:
+                    self.ready.append(chat_id)
+                    self.cond.notify()
+                if len(self.chat_buckets) > self.sweep_size:
+                    self.sweep_buckets()
+
+    # Drops the rate limits of idle chats whose bucket is full again. Called with cond held
+    def sweep_buckets(self):
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.busy and bucket.full():
+                del self.chat_buckets[chat_id]
+        # Chats that are still limited are not looked at again until the map doubled
+        self.sweep_size = max(CHAT_BUCKETS_SWEEP, 2 * len(self.chat_buckets))
+
+    def deliver(self, chat_id, messages):
+        with self.cond:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        sent = True
+        for text in coalesce_messages([text for text, enqueued in messages]):
+            sent = self.send(chat_id, bucket, text) and sent
+        now = time.time()
+        with self.cond:
+            for text, enqueued in messages:
+                if sent:
+                    self.sent += 1
+                    self.latency_total += now - enqueued
+                    self.latency_max = max(self.latency_max, now - enqueued)
+                else:
+                    self.failed += 1
+
+    def send(self, chat_id, bucket, text):
+        for attempt in range(self.max_retries + 1):
+            time.sleep(max(bucket.reserve(), self.global_bucket.reserve()))
+            try:
+                self.bot.send_message(
+                    parse_mode = ParseMode.MARKDOWN,
+                    chat_id = chat_id,
+                    text = text,
+                    disable_web_page_preview = True
+                )
+                return True
+            except RetryAfter as error:
+                delay = error.retry_after
+            except (BadRequest, Unauthorized) as error:
+                # Blocked by the user, chat not found etc. Retrying will not help
+                logging.warning('Dropping message to chat %s: %s' % (chat_id, error))
+                return False
+            except (TimedOut, NetworkError):
+                delay = min(60, 2 ** attempt)
+            with self.cond:
+                self.retried += 1
+            logging.info('Retrying message to chat %s in %s seconds' % (chat_id, delay))
+            if self.shutdown_flag.wait(delay):
+                return False
+        return False
+
+
+class QueryCache(object):
+
+    # LRU cache of query results and rendered messages. Keys carry the data generation so
+    # entries of older data are never returned, and an entry may also expire at a given time.
+    # Every entry weighs the number of hikes it holds and the least recently used entries are
+    # evicted once the total weight goes over max_weight
+    def __init__(self, max_weight = QUERY_CACHE_WEIGHT):
+        self.max_weight = max_weight
+        self.entries = OrderedDict()
+        self.weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, weight, value = entry
+                if expires is None or (now or datetime.now()) < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.weight -= weight
+            self.misses += 1
+            return None
+
+    def put(self, key, value, weight, expires = None):
+        # Weigh at least one so that empty results still count towards the limit
+        weight = max(1, weight)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.weight -= previous[1]
+            self.entries[key] = (expires, weight, value)
+            self.weight += weight
+            while self.weight > self.max_weight and len(self.entries) > 1:
+                evicted_key, evicted = self.entries.popitem(last = False)
+                self.weight -= evicted[1]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return { 'entries': len(self.entries), 'weight': self.weight, 'hits': self.hits,
+                     'misses': self.misses, 'hit_rate': float(self.hits) / total if total else 0.0 }
+
+
+class FetchCache(object):
+
+    # Remembers the validators, body digest and decoded body of every fetched page so that
+    # unchanged pages are neither downloaded again (when the upstream sends ETag/Last-Modified)
+    # nor decoded again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = dict()
+        self.responses = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def request_headers(self, key):
+        headers = dict()
+        with self.lock:
+            entry = self.pages.get(key)
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Returns the cached page if the response shows it did not change, None otherwise
+    def lookup(self, key, resp, digest):
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is not None and (resp.status_code == 304 or entry['digest'] == digest):
+                self.hits += 1
+                return entry['page']
+            self.misses += 1
+            return None
+
+    def store(self, key, resp, digest, page):
+        with self.lock:
+            self.pages[key] = {
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'digest': digest,
+                'page': page
+            }
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return { 'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': float(self.hits) / total if total else 0.0 }
+
+
+class Hike(object):
+
+    # One upstream event. The link and the display date are only derived when the hike is
+    # rendered. timestamp is the date as seconds, used by the columns of the HikeStore
+    __slots__ = ('id', 'name', 'difficulty', 'organiser', 'date', 'timestamp', '_date_string')
+
+    def __init__(self, hike_id, name, difficulty, organiser, date):
+        self.id = hike_id
+        self.name = name
+        self.difficulty = difficulty
+        self.organiser = organiser
+        self.date = date
+        self.timestamp = to_timestamp(date)
+        self._date_string = None
+
+    @property
+    def link(self):
+        return 'https://www.hiking-buddies.com/routes/events/%s/' % self.id
+
+    @property
+    def date_string(self):
+        if self._date_string is None:
+            self._date_string = get_date_string(self.date)
+        return self._date_string
+
+
+class HikeStore(object):
+
+    # Read-only indexes over the hikes of one refresh. All query results are sorted by date.
+    # Hikes are kept sorted by date next to parallel columns of their difficulty value and
+    # timestamp, so that a position range is a date range and filters compare plain numbers
+    def __init__(self, hikes):
+        self.hikes = sorted(hikes, key = lambda hike: hike.timestamp)
+        self.levels = array('b', [hike.difficulty.value for hike in self.hikes])
+        self.timestamps = array('q', [hike.timestamp for hike in self.hikes])
+        self.by_difficulty = dict((difficulty, []) for difficulty in Difficulty)
+        # Positions of the hikes of every lowercase organiser name
+        self.by_organiser = dict()
+        for position, hike in enumerate(self.hikes):
+            self.by_difficulty[hike.difficulty].append(hike)
+            self.by_organiser.setdefault(hike.organiser.lower(), []).append(position)
+        self.difficulty_timestamps = dict((difficulty, array('q', [hike.timestamp for hike in bucket]))
+            for difficulty, bucket in self.by_difficulty.items())
+        # Sorted distinct organiser names
+        self.organisers = sorted(self.by_organiser)
+        self._search = None
+
+    def __len__(self):
+        return len(self.hikes)
+
+    # The SearchIndex of inline queries. publish_hikes builds it before the store is published
+    @property
+    def search(self):
+        if self._search is None:
+            self._search = SearchIndex(self)
+        return self._search
+
+    def organisers_containing(self, name):
+        # Scans distinct organisers only, which are far fewer than hikes
+        name = name.lower()
+        return [organiser for organiser in self.organisers if name in organiser]
+
+    # Range of positions with date_from <= date < date_to
+    def positions(self, date_from = None, date_to = None):
+        return position_range(self.timestamps, date_from, date_to)
+
+    def query(self, date_from = None, date_to = None, diff_lo = None, diff_hi = None, organiser = None,
+            weekdays = None):
+        # date_from is inclusive and date_to exclusive. Any of the filters may be None
+        hikes = self.select(date_from, date_to, diff_lo, diff_hi, organiser)
+        if weekdays is not None:
+            weekdays = set(weekdays)
+            hikes = [hike for hike in hikes if hike.date.weekday() in weekdays]
+        return hikes
+
+    def select(self, date_from, date_to, diff_lo, diff_hi, organiser):
+        if organiser is not None:
+            start, end = self.positions(date_from, date_to)
+            positions = heapq.merge(*[self.by_organiser[name] for name in self.organisers_containing(organiser)])
+            if diff_lo is not None or diff_hi is not None:
+                lo, hi = difficulty_bounds(diff_lo, diff_hi)
+                levels = self.levels
+                return [self.hikes[position] for position in positions
+                    if start <= position < end and lo <= levels[position] <= hi]
+            return [self.hikes[position] for position in positions if start <= position < end]
+        if diff_lo is not None or diff_hi is not None:
+            buckets = []
+            for difficulty in difficulty_range(diff_lo, diff_hi):
+                start, end = position_range(self.difficulty_timestamps[difficulty], date_from, date_to)
+                buckets.append(self.by_difficulty[difficulty][start:end])
+            return list(heapq.merge(*buckets, key = lambda hike: hike.timestamp))
+        start, end = self.positions(date_from, date_to)
+        return self.hikes[start:end]
+
+
+class SearchIndex(object):
+
+    # Trigram index over the names and organisers of the hikes of one HikeStore. Words are
+    # padded with a space on both sides so that word starts and short words have trigrams of
+    # their own. A query matches the hikes that share enough of its trigrams, which tolerates
+    # typos and any word order, and ranks them by the number of shared trigrams, then by date
+    def __init__(self, store):
+        self.store = store
+        postings = dict()
+        for position, hike in enumerate(store.hikes):
+            for gram in hike_trigrams(hike.name, hike.organiser):
+                postings.setdefault(gram, []).append(position)
+        self.postings = postings
+
+    # words are normalised. With partial the last word is still being typed and only has to
+    # match the start of a word. difficulties is a set of Difficulty values or None
+    def search(self, words, partial = False, difficulties = None, limit = INLINE_RESULTS_LIMIT):
+        hikes = self.store.hikes
+        if not words:
+            if difficulties is None:
+                return hikes[:limit]
+            buckets = [self.store.by_difficulty[difficulty] for difficulty in Difficulty
+                if difficulty.value in difficulties]
+            return list(itertools.islice(heapq.merge(*buckets, key = lambda hike: hike.timestamp), limit))
+        grams = set(search_trigrams(words, partial))
+        counts = Counter()
+        for gram in grams:
+            positions = self.postings.get(gram)
+            if positions is not None:
+                counts.update(positions)
+        required = max(1, int(len(grams) * SEARCH_MIN_SIMILARITY + 0.5))
+        levels = self.store.levels
+        candidates = [(-count, position) for position, count in counts.items() if count >= required and
+            (difficulties is None or levels[position] in difficulties)]
+        # Positions are in date order so ties go to the earlier hike
+        return [hikes[position] for count, position in heapq.nsmallest(limit, candidates)]
+
+
 class HikesLoader(Job):
+
+    # With a bot, subscriptions are notified of new hikes right after they are published
+    def __init__(self, sleep_seconds, scheduler = None, bot = None):
+        Job.__init__(self, sleep_seconds, scheduler)
+        self.bot = bot
+        # Previous snapshot keyed by the raw hike id: (row hash, parsed hike, raw row)
+        self.snapshot = dict()
+        # Raw rows written and ids removed by the last refresh, used to persist the snapshot
+        self.changed_rows = []
+        self.removed_keys = []
+        # False after a failed save, until every hike was written again
+        self.snapshot_saved = True
+        self.fetch_cache = FetchCache()
+
     def task(self):
-        global __latest_hike_id__
-        global __hikes_data__
-        response = makerequest()
+        start = time.perf_counter()
+        response = makerequest(cache = self.fetch_cache)
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+        # Keep serving the previous snapshot if the request failed or nothing changed upstream
+        if response is None:
+            FETCH_RESULTS.inc(labels = ('failed',))
+            self.scheduler.failed()
+        elif response.get('unchanged', False):
+            FETCH_RESULTS.inc(labels = ('unchanged',))
+            self.scheduler.observe(False)
+        else:
+            start = time.perf_counter()
+            changes = self.refresh(response['data'])
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+            changed = bool(changes.added or changes.updated or changes.removed)
+            FETCH_RESULTS.inc(labels = ('changed' if changed else 'same',))
+            # The first successful fetch is published even when empty, so the bot stops loading
+            if changed or __snapshot__.generation == 0:
+                previous = __snapshot__
+                publish_hikes([entry[1] for entry in self.snapshot.values()], changes)
+                self.persist_snapshot()
+                if __shards__ is not None:
+                    __shards__.publish(__snapshot__)
+                elif self.bot is not None:
+                    # The refresh is done either way, so the changes are still archived and observed
+                    try:
+                        notify_new_hikes(self.bot, [hike for hike in changes.added if hike.id > previous.latest_id],
+                            __snapshot__.latest_id)
+                        record_notified(__snapshot__.latest_id)
+                    except Exception:
+                        logging.exception("Notifying new hikes failed")
+                if __archive__ is not None:
+                    self.archive(changes)
+            # New hikes tighten the polling interval, other changes do not
+            self.scheduler.observe(bool(changes.added))
+
+    # Runs after the new hikes were published and notified. A failing archive is logged and
+    # does not stop the live hikes from being refreshed
+    def archive(self, changes):
+        start = time.perf_counter()
+        try:
+            __archive__.record(changes.added + changes.updated)
+            __archive__.forget(changes.removed)
+        except OSError:
+            logging.exception("Archiving hikes failed")
+        ARCHIVE_SECONDS.observe(time.perf_counter() - start)
+
+    # Diffs the raw rows against the previous snapshot. Only added or changed rows are parsed
+    def refresh(self, rows):
+        snapshot = dict()
+        added = []
+        updated = []
+        changed_rows = []
+        for row in rows:
+            if len(row) < 6:
+                logging.warning("Skipping hike row with %d columns" % len(row))
+                continue
+            row_hash = hash(tuple(row))
+            previous = self.snapshot.get(row[5])
+            if previous is not None and previous[0] == row_hash:
+                snapshot[row[5]] = previous
+                continue
+            try:
+                hike = parse_hike(row)
+            except (ValueError, TypeError) as error:
+                # Skip the row rather than the whole refresh
+                logging.warning("Skipping hike row: %s" % error)
+                continue
+            snapshot[row[5]] = (row_hash, hike, row)
+            changed_rows.append(row)
+            if previous is None:
+                added.append(hike)
+            else:
+                updated.append(hike)
+        removed_keys = [key for key in self.snapshot if key not in snapshot]
+        removed = [self.snapshot[key][1] for key in removed_keys]
+        self.snapshot = snapshot
+        self.changed_rows = changed_rows
+        self.removed_keys = removed_keys
+        return HikesChangeset(added, updated, removed)
+
+    # Loads the snapshot persisted by the previous run so that commands are answered correctly
+    # before the first fetch completes. The first fetch is then diffed against it as usual
+    def load_snapshot(self):
+        global __snapshot__
+        with closing(open_database()) as conn:
+            rows = [json.loads(row) for (row,) in conn.execute(SELECT_HIKES)]
+            state = conn.execute(SELECT_STATE, ('latest_hike_id',)).fetchone()
+        changes = self.refresh(rows)
+        if rows:
+            publish_hikes([entry[1] for entry in self.snapshot.values()], changes)
+        if state is not None and state[0] > __snapshot__.latest_id:
+            # Runs before any other thread starts so nothing else is publishing
+            __snapshot__ = __snapshot__._replace(latest_id = state[0])
+        logging.info("loaded %d hikes from the snapshot" % len(rows))
+
+    # A failing save is logged like a failing archive, so the new hikes are still notified. The
+    # next save then rewrites every hike, as the rows of this refresh were never written
+    def persist_snapshot(self):
+        try:
+            self.save_snapshot()
+            self.snapshot_saved = True
+        except sqlite3.Error:
+            logging.exception("Saving hikes failed")
+            self.snapshot_saved = False
+
+    # Writes the rows changed by the last refresh. A short lived connection keeps this usable
+    # from whichever thread runs the task
+    def save_snapshot(self):
+        with closing(open_database()) as conn:
+            with conn:
+                if self.snapshot_saved:
+                    conn.executemany(DELETE_HIKE, [(key,) for key in self.removed_keys])
+                    rows = self.changed_rows
+                else:
+                    conn.execute(DELETE_HIKES)
+                    rows = [entry[2] for entry in self.snapshot.values()]
+                conn.executemany(INSERT_HIKE, [(row[5], json.dumps(row)) for row in rows])
+                conn.execute(INSERT_STATE, ('latest_hike_id', __snapshot__.latest_id))
+
+
+class OrganiserAutomaton(object):
+
+    # Aho-Corasick automaton over lowercase organiser substrings. search() finds every pattern
+    # contained in a name in one pass over the name, however many patterns there are
+    def __init__(self, patterns):
+        # Per state: transitions, failure link and the values of patterns ending there
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern, value in patterns:
+            state = 0
+            for char in pattern.lower():
+                following = self.goto[state].get(char)
+                if following is None:
+                    following = len(self.goto)
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = following
+                state = following
+            self.out[state].append(value)
+        # Breadth first so that failure links always point to states already finished
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, following in self.goto[state].items():
+                pending.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0)
+                self.out[following] = self.out[following] + self.out[self.fail[following]]
+
+    def search(self, name):
+        found = set()
+        state = 0
+        for char in name.lower():
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.out[state])
+        return found
+
+
+class SubscriptionIndex(object):
+
+    # Reverse index from a hike to the subscriptions it matches. Subscriptions are grouped by
+    # their command so every distinct command is matched once. eventsall matches every hike,
+    # eventsweek ranges are bucketed by difficulty value, eventsorganiser substrings go into an
+    # OrganiserAutomaton and anything else is checked with command_matches
+    def __init__(self, subscriptions):
+        self.groups = dict()
+        for subscription in subscriptions:
+            command = subscription['command']
+            if not command.get('valid'):
+                continue
+            key = subscription_key(command)
+            self.groups.setdefault(key, (command, []))[1].append(subscription['id'])
+        self.always = []
+        self.by_difficulty = dict((difficulty.value, []) for difficulty in Difficulty)
+        organisers = []
+        self.residual = []
+        for key, (command, ids) in self.groups.items():
+            if command['command'] == 'eventsall':
+                self.always.append(key)
+            elif command['command'] == 'eventsweek':
+                if command['diff_lo'] is None and command['diff_hi'] is None:
+                    difficulties = list(Difficulty)
+                else:
+                    difficulties = difficulty_range(command['diff_lo'], command['diff_hi'])
+                for difficulty in difficulties:
+                    self.by_difficulty[difficulty.value].append(key)
+            elif command['command'] == 'eventsorganiser':
+                organisers.append((command['organiser'], key))
+            else:
+                self.residual.append(key)
+        self.organisers = OrganiserAutomaton(organisers)
+
+    # Keys of the commands that include hike
+    def match(self, hike, now):
+        keys = set(self.always)
+        keys.update(self.organisers.search(hike.organiser))
+        week_end_timestamp = to_timestamp(week_end(now))
+        if hike.timestamp < week_end_timestamp:
+            keys.update(self.by_difficulty.get(hike.difficulty.value, ()))
+        for key in self.residual:
+            # A command that cannot be matched must not keep the other subscriptions waiting
+            try:
+                if command_matches(self.groups[key][0], hike, now):
+                    keys.add(key)
+            except Exception:
+                logging.exception("Matching subscription command %s failed" % key)
+        return keys
+
+class Metric(object):
+
+    # A metric family in the Prometheus text format. Every combination of label values gets
+    # its own child, unlabelled metrics have a single child. With a function the value is read
+    # when the metrics are scraped instead of being updated on the hot path
+    kind = 'untyped'
+
+    def __init__(self, name, help, label_names = (), function = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.children = dict()
+        self.lock = threading.Lock()
+        # Unlabelled metrics are reported as zero before the first update
+        if not self.label_names and function is None:
+            self.children[()] = self.new_child()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        return [0.0]
+
+    def format_labels(self, values, extra = ()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        if self.function is not None:
+            lines.append('%s %s' % (self.name, format_metric_value(self.function())))
+        for values, child in sorted(self.children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+    def render_child(self, values, child):
+        return ['%s%s %s' % (self.name, self.format_labels(values), format_metric_value(child[0]))]
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, labels = ()):
+        child = self.labels(*labels)
+        with self.lock:
+            child[0] += amount
+
+
+class GaugeMetric(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels = ()):
+        self.labels(*labels)[0] = value
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+    # Seconds, from a fast command to a slow fetch
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, label_names = (), buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, help, label_names)
+
+    # Per bucket counts (the last one is +Inf), then the sum and the count of observations
+    def new_child(self):
+        return [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+    def observe(self, value, labels = ()):
+        child = self.labels(*labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            child[index] += 1
+            child[-2] += value
+            child[-1] += 1
+
+    def render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name,
+                self.format_labels(values, [('le', '+Inf' if bound == float('inf') else repr(bound))]),
+                cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self.format_labels(values), format_metric_value(child[-2])))
+        lines.append('%s_count%s %d' % (self.name, self.format_labels(values), child[-1]))
+        return lines
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names = (), function = None):
+        return self.register(CounterMetric(name, help, label_names, function))
+
+    def gauge(self, name, help, label_names = (), function = None):
+        return self.register(GaugeMetric(name, help, label_names, function))
+
+    def histogram(self, name, help, label_names = (), buckets = HistogramMetric.BUCKETS):
+        return self.register(HistogramMetric(name, help, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # A broken gauge function must not take the whole scrape down
+                logging.exception('Rendering metric %s failed' % metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler(object):
+
+    # Samples the stacks of every other thread at a fixed interval while running. The result
+    # is in the collapsed format of flamegraph.pl: one "outer;...;inner count" line per stack
+    def __init__(self, interval = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = dict()
+        self.samples = 0
+        self.thread = None
+        self.shutdown_flag = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval = None):
+        with self.lock:
+            if self.running:
+                return False
+            self.interval = interval or self.interval
+            self.stacks = dict()
+            self.samples = 0
+            self.shutdown_flag.clear()
+            self.thread = Thread(target = self.sample)
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+            self.shutdown_flag.set()
+            self.thread.join()
+            return True
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.shutdown_flag.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def report(self):
+        stacks = sorted(self.stacks.items(), key = lambda item: -item[1])
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    # GET /metrics                      Prometheus text format
+    # GET /profile/start?interval=0.01  starts the sampling profiler
+    # GET /profile/stop                 stops it
+    # GET /profile                      collapsed stacks sampled so far
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self.reply(200, __metrics__.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif url.path == '/profile/start':
+            interval = parse_qs(url.query).get('interval')
+            try:
+                interval = float(interval[0]) if interval else None
+            except ValueError:
+                return self.reply(400, 'interval must be a number of seconds\n')
+            started = __profiler__.start(interval)
+            self.reply(200, 'profiler started\n' if started else 'profiler already running\n')
+        elif url.path == '/profile/stop':
+            stopped = __profiler__.stop()
+            self.reply(200, 'profiler stopped after %d samples\n' % __profiler__.samples if stopped
+                else 'profiler not running\n')
+        elif url.path == '/profile':
+            self.reply(200, __profiler__.report())
+        else:
+            self.reply(404, 'not found\n')
+
+    def reply(self, status, text, content_type = 'text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics endpoint: ' + format % args)
+
+
+class MetricsServer(Thread):
+
+    # Serves MetricsRequestHandler on localhost in the background
+    def __init__(self, port, host = '127.0.0.1'):
+        Thread.__init__(self)
+        self.daemon = True
+        self.server = HTTPServer((host, port), MetricsRequestHandler)
+
+    def run(self):
+        logging.info('Serving metrics on %s:%d' % self.server.server_address)
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        __profiler__.stop()
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    # Accepts Telegram updates posted to the webhook path. Updates are acknowledged as soon as
+    # they are queued; a full queue answers 503 so that Telegram retries the update later
+    def do_POST(self):
+        webhook = self.server.webhook
+        if urlparse(self.path).path != webhook.path:
+            return self.reply(404)
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token') or ''
+        if not hmac.compare_digest(secret.encode('utf-8'), webhook.secret.encode('utf-8')):
+            WEBHOOK_UPDATES.inc(labels = ('forbidden',))
+            return self.reply(403)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > WEBHOOK_MAX_BODY:
+            WEBHOOK_UPDATES.inc(labels = ('invalid',))
+            return self.reply(413 if length > 0 else 400)
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(length).decode('utf-8')), webhook.bot)
+        except Exception:
+            WEBHOOK_UPDATES.inc(labels = ('invalid',))
+            return self.reply(400)
+        if not webhook.submit(update):
+            WEBHOOK_UPDATES.inc(labels = ('shed',))
+            return self.reply(503, { 'Retry-After': '1' })
+        WEBHOOK_UPDATES.inc(labels = ('accepted',))
+        self.reply(200)
+
+    def reply(self, status, headers = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug('webhook: ' + format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebhookServer(Thread):
+
+    # Receives updates from Telegram instead of polling for them. Updates are handed to the
+    # dispatcher on a pool of workers, and at most max_pending updates wait or run at a time
+    def __init__(self, bot, dispatcher, port, host = '127.0.0.1', path = '/', secret = None,
+            workers = WEBHOOK_WORKERS, max_pending = WEBHOOK_MAX_PENDING):
+        Thread.__init__(self)
+        self.daemon = True
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        self.server.webhook = self
+
+    def run(self):
+        logging.info('Receiving updates on %s:%d%s' % (self.server.server_address + (self.path,)))
+        self.server.serve_forever()
+
+    # Returns False without queueing the update if max_pending updates are already queued
+    def submit(self, update):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+        try:
+            self.pool.submit(self.process, update)
+        except RuntimeError:
+            # The pool is shutting down
+            self.done()
+            return False
+        return True
+
+    def process(self, update):
+        try:
+            self.dispatcher.process_update(update)
+        except Exception:
+            logging.exception('Processing update %s failed' % update.update_id)
+        finally:
+            self.done()
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+
+    # Registers the webhook with Telegram. url is the public https url that reaches this server
+    def register(self, url):
+        self.bot.set_webhook(url = url, max_connections = WEBHOOK_MAX_CONNECTIONS, secret_token = self.secret)
+
+    # Stops accepting updates and waits for the queued ones to be processed
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.shutdown(wait = True)
+
+class BotFactory(object):
+
+    # Creates the Bot of a notification shard. Processes are spawned, so it has to pickle
+    def __init__(self, token, base_url = None):
+        self.token = token
+        self.base_url = base_url
+
+    def __call__(self):
+        return Bot(self.token, base_url = self.base_url)
+
+
+class NotificationShards(object):
+
+    # Runs subscription matching and delivery on worker processes. Subscriptions are split by
+    # chat id, so a worker owns all subscriptions of its chats. Published hikes reach the workers
+    # through a snapshot file they memory map; only small counters, wake ups and the advanced
+    # last_ids of subscriptions go between processes. This process stays the only writer of
+    # the database: advances are put on the subscription queue like any other update
+    def __init__(self, shards, bot_factory, snapshot_path = SNAPSHOT_FILE, send_rate = GLOBAL_SEND_RATE):
+        context = multiprocessing.get_context('spawn')
+        self.shards = shards
+        self.snapshot_path = snapshot_path
+        self.generation = context.Value('q', 0)
+        self.subscriptions_version = context.Value('q', 0)
+        self.stopping = context.Event()
+        self.wakes = [context.Event() for _ in range(shards)]
+        self.results = context.Queue()
+        # Telegram limits the bot as a whole, so the workers share the send rate
+        self.workers = [context.Process(target = run_notification_shard, args = (shard, shards, snapshot_path,
+            DATABASE, self.generation, self.subscriptions_version, self.wakes[shard], self.stopping, self.results,
+            bot_factory, float(send_rate) / shards if send_rate else None)) for shard in range(shards)]
+        self.collector = Thread(target = self.collect)
+        self.cond = threading.Condition()
+        # Last generation every worker has finished, and the latest hike id of the generations
+        # that are not finished by every worker yet
+        self.processed = [0] * shards
+        self.latest_ids = dict()
+
+    def start(self):
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        self.collector.start()
+
+    def stop(self, timeout = None):
+        self.stopping.set()
+        self.wake()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.results.put(None)
+        self.collector.join(timeout)
+
+    def wake(self):
+        for wake in self.wakes:
+            wake.set()
+
+    # Writes the snapshot file and then tells the workers about the new generation
+    def publish(self, snapshot):
+        with self.cond:
+            self.latest_ids[snapshot.generation] = snapshot.latest_id
+        write_snapshot_file(self.snapshot_path, snapshot)
+        self.generation.value = snapshot.generation
+        self.wake()
+
+    # Workers reload their subscriptions after subscriptions were added or removed
+    def subscriptions_changed(self):
+        with self.subscriptions_version.get_lock():
+            self.subscriptions_version.value += 1
+        self.wake()
+
+    def collect(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            shard, generation, advances, notifications = message
+            NOTIFICATIONS.inc(notifications)
+            advance_subscriptions(advances)
+            with self.cond:
+                self.processed[shard] = max(self.processed[shard], generation)
+                finished = [published for published in self.latest_ids if published <= min(self.processed)]
+                if finished:
+                    record_notified(max(self.latest_ids.pop(published) for published in finished))
+                self.cond.notify_all()
+
+    # Waits until every worker has finished generation. Returns False on timeout
+    def wait_processed(self, generation, timeout = None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while min(self.processed) < generation:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+
+class HikesArchive(object):
+
+    # Append-only history of every published hike, partitioned by the month of the hike date.
+    # A partition is a file of hike records, in the format of the snapshot file, and an index
+    # with the offset of the latest record of every hike, grouped by lowercase organiser and by
+    # difficulty value. Records are appended before the index is replaced, so readers that load
+    # the index first never see an offset past the end of the records they map. Queries read
+    # only the partitions they need and keep nothing in memory. The writer only remembers the
+    # month of the live hikes, to mark a hike that moved to another month as removed
+    def __init__(self, path):
+        self.path = path
+        self.months = dict()
+        os.makedirs(path, exist_ok = True)
+
+    def partition_path(self, month, extension):
+        return os.path.join(self.path, '%s.%s' % (month, extension))
+
+    # Months with a partition, oldest first
+    def partitions(self):
+        return sorted(match.group(1) for match in map(ARCHIVE_PARTITION.match, os.listdir(self.path)) if match)
+
+    def load_index(self, month):
+        try:
+            with open(self.partition_path(month, 'idx')) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return { 'size': 0, 'records': {}, 'organisers': {}, 'difficulties': {} }
+
+    # Index of a partition before records are appended to it. Records appended after the index
+    # was last written, eg: before a crash, are indexed again and a torn last record is cut off
+    def open_partition(self, month):
+        index = self.load_index(month)
+        path = self.partition_path(month, 'dat')
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > index['size']:
+            with open(path, 'rb') as fp:
+                fp.seek(index['size'])
+                tail = fp.read()
+            offset = 0
+            while offset + HIKE_RECORD.size <= len(tail):
+                hike_id, timestamp, level, name_length, organiser_length = HIKE_RECORD.unpack_from(tail, offset)
+                end = offset + HIKE_RECORD.size + name_length + organiser_length
+                if end > len(tail):
+                    break
+                organiser = tail[end - organiser_length:end].decode('utf-8')
+                self.index_record(index, index['size'] + offset, hike_id, level, organiser)
+                offset = end
+            index['size'] += offset
+            if index['size'] < size:
+                logging.warning("Cutting off %d bytes of a torn record in %s" % (size - index['size'], path))
+                os.truncate(path, index['size'])
+        return index
+
+    def index_record(self, index, offset, hike_id, level, organiser):
+        if level == ARCHIVE_REMOVED:
+            index['records'].pop(str(hike_id), None)
+        else:
+            index['records'][str(hike_id)] = [offset, level, organiser.lower()]
+
+    # The lookups of readers are derived from the records. Written next to the final file and
+    # renamed over it like the snapshot file
+    def write_index(self, month, index):
+        organisers = dict()
+        difficulties = dict()
+        for offset, level, organiser in index['records'].values():
+            organisers.setdefault(organiser, []).append(offset)
+            difficulties.setdefault(str(level), []).append(offset)
+        index['organisers'] = dict((organiser, sorted(offsets)) for organiser, offsets in organisers.items())
+        index['difficulties'] = dict((level, sorted(offsets)) for level, offsets in difficulties.items())
+        path = self.partition_path(month, 'idx')
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(index, fp, separators = (',', ':'))
+        os.replace(path + '.tmp', path)
+
+    # entries are (hike id, difficulty value, organiser, packed record)
+    def append(self, month, entries):
+        index = self.open_partition(month)
+        offset = index['size']
+        for hike_id, level, organiser, record in entries:
+            self.index_record(index, offset, hike_id, level, organiser)
+            offset += len(record)
+        with open(self.partition_path(month, 'dat'), 'ab') as fp:
+            fp.write(b''.join(entry[3] for entry in entries))
+        index['size'] = offset
+        self.write_index(month, index)
+
+    # Appends the latest version of hikes that were added or updated
+    def record(self, hikes):
+        appends = dict()
+        for hike in hikes:
+            month = archive_month(hike.date)
+            previous = self.months.get(hike.id)
+            if previous is not None and previous != month:
+                appends.setdefault(previous, []).append((hike.id, ARCHIVE_REMOVED, '',
+                    HIKE_RECORD.pack(hike.id, 0, ARCHIVE_REMOVED, 0, 0)))
+            appends.setdefault(month, []).append((hike.id, hike.difficulty.value, hike.organiser, pack_hike(hike)))
+            self.months[hike.id] = month
+        for month in sorted(appends):
+            self.append(month, appends[month])
+
+    # Hikes that left the live list stay archived as they were last seen
+    def forget(self, hikes):
+        for hike in hikes:
+            self.months.pop(hike.id, None)
+
+    # Takes over the live hikes loaded on startup and archives those that are missing, eg: the
+    # first time the archive is used
+    def seed(self, hikes):
+        by_month = dict()
+        for hike in hikes:
+            by_month.setdefault(archive_month(hike.date), []).append(hike)
+        missing = []
+        for month, group in by_month.items():
+            records = self.open_partition(month)['records']
+            missing.extend(hike for hike in group if str(hike.id) not in records)
+            self.months.update((hike.id, month) for hike in group)
+        self.record(missing)
+
+    # The latest archived hikes of organisers whose name contains name, sorted by date. Only
+    # partitions whose index has such an organiser are mapped, newest first until limit is reached
+    def history(self, name, limit = ARCHIVE_HISTORY_LIMIT):
+        name = name.lower()
+        hikes = []
+        for month in reversed(self.partitions()):
+            organisers = self.load_index(month)['organisers']
+            offsets = [offset for organiser, offsets in organisers.items() if name in organiser
+                for offset in offsets]
+            if not offsets:
+                continue
+            with open(self.partition_path(month, 'dat'), 'rb') as fp:
+                with closing(mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)) as buffer:
+                    found = [unpack_hike(buffer, offset) for offset in offsets]
+            hikes.extend(sorted(found, key = lambda hike: hike.timestamp, reverse = True))
+            if len(hikes) >= limit:
+                break
+        return sorted(hikes[:limit], key = lambda hike: hike.timestamp)
+
+    # (month, number of hikes by difficulty value) of every partition from month_from to
+    # month_to, both yyyy-mm and inclusive. Answered from the indexes alone
+    def counts(self, month_from = None, month_to = None):
         result = []
-        if response is not None:
-            hikes = response['data']
-            for hike in hikes:
-                hike_id = int(hike[5])
-                __latest_hike_id__ = hike_id if __latest_hike_id__ < hike_id else __latest_hike_id__
-                result.append(
-                    { 'id': int(hike[5]),
-                      'name': hike[1],
-                      'difficulty': Difficulty[hike[2]] if hike[2] in Difficulty.__members__ else Difficulty.T0,
-                      'organiser': hike[3],
-                      'date': parse_date_string(hike[4]),
-                      'link': 'https://www.hiking-buddies.com/routes/events/%s/' % (hike[5])
-                    }
-                )
-        ## put the result in the global variable
-        __hikes_data__ = result
+        for month in self.partitions():
+            if (month_from and month < month_from) or (month_to and month > month_to):
+                continue
+            difficulties = self.load_index(month)['difficulties']
+            result.append((month, dict((int(level), len(offsets)) for level, offsets in difficulties.items())))
+        return result
 
 ## End Class Definitions
 
 
+## Published shared state
+# Replaced as a whole by a single reference assignment. Readers take one reference and use it
+# throughout so they never see parts of two different refreshes
+__snapshot__ = HikesSnapshot(HikeStore([]), dict(), 0, 0)
+__subscriptions__ = SubscriptionRegistry()
+
+
+## Metrics
+# Updated on the hot paths and served by the MetricsServer when HBM_METRICS_PORT is set
+__metrics__ = MetricsRegistry()
+__profiler__ = SamplingProfiler()
+FETCH_SECONDS = __metrics__.histogram('hbm_fetch_seconds', 'Time to fetch every page of the event list')
+FETCH_RESULTS = __metrics__.counter('hbm_fetch_total', 'Event list fetches by result', ['result'])
+PARSE_SECONDS = __metrics__.histogram('hbm_parse_seconds', 'Time to diff and parse a fetched event list')
+__metrics__.gauge('hbm_hikes', 'Number of published hikes', function = lambda: len(__snapshot__.store.hikes))
+__metrics__.gauge('hbm_snapshot_generation', 'Generation of the published hikes',
+    function = lambda: __snapshot__.generation)
+__metrics__.gauge('hbm_subscriptions', 'Number of subscriptions',
+    function = lambda: len(__subscriptions__.current()))
+__metrics__.gauge('hbm_subscription_queue_depth', 'Subscription updates waiting to be written',
+    function = lambda: __subscription_queue__.qsize())
+FLUSH_SECONDS = __metrics__.histogram('hbm_subscription_flush_seconds',
+    'Time to write the queued subscription updates')
+FLUSHED_UPDATES = __metrics__.counter('hbm_subscription_updates_total',
+    'Subscription updates written by action', ['action'])
+NOTIFY_SECONDS = __metrics__.histogram('hbm_notify_seconds', 'Time to match hikes and notify subscriptions')
+NOTIFICATIONS = __metrics__.counter('hbm_notifications_total', 'Subscription notifications sent')
+ARCHIVE_SECONDS = __metrics__.histogram('hbm_archive_seconds', 'Time to archive the hikes changed by a refresh')
+__metrics__.gauge('hbm_outbox_depth', 'Messages waiting in the outbound queue',
+    function = lambda: __outbox__.depth() if __outbox__ is not None else 0)
+WEBHOOK_UPDATES = __metrics__.counter('hbm_webhook_updates_total', 'Updates posted to the webhook by result',
+    ['result'])
+__metrics__.gauge('hbm_webhook_pending', 'Webhook updates waiting or being handled',
+    function = lambda: __webhook_server__.pending if __webhook_server__ is not None else 0)
+COMMAND_SECONDS = __metrics__.histogram('hbm_command_seconds', 'Handler latency by command', ['command'])
+COMMAND_ERRORS = __metrics__.counter('hbm_command_errors_total', 'Handlers that raised by command', ['command'])
+
+
 ## Begin Helper Functions
-def makerequest():
-    url = 'https://www.hiking-buddies.com/routes/event_list/get_event_list/'
-    params = dict(
+# Integral values without a trailing .0 and the special floats as Prometheus spells them
+def format_metric_value(value):
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return '%d' % value
+    return repr(value)
+
+
+def open_database():
+    conn = sqlite3.connect(DATABASE)
+    conn.execute(CREATE_HIKES)
+    conn.execute(CREATE_STATE)
+    return conn
+
+
+def get_http_session():
+    # Shared keep-alive session so that polling reuses TCP+TLS connections
+    global __http_session__
+    if __http_session__ is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = FETCH_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        __http_session__ = session
+    return __http_session__
+
+
+def get_fetch_pool():
+    global __fetch_pool__
+    if __fetch_pool__ is None:
+        __fetch_pool__ = ThreadPoolExecutor(max_workers = FETCH_WORKERS)
+    return __fetch_pool__
+
+
+def event_list_params(start, length):
+    return dict(
         [
             ('draw', 5),
             ('columns[0][data]', 0),
@@ -208,21 +1922,202 @@ def makerequest():
             ('columns[5][orderable]', True),
             ('columns[5][search][value]', ''),
             ('columns[5][search][regex]', False),
-            ('start', 0),
-            ('length', 100),
+            ('start', start),
+            ('length', length),
             ('search[value]', ''),
             ('search[regex]', False),
             ('id', 'id_future')
         ]
     )
-    resp = requests.get(url=url, params=params)
-    logging.info(resp.url)
-    logging.info(resp.status_code)
+
+
+# Returns (page, cached) where cached tells if the page was served from the fetch cache
+def fetch_page(url, start, length, cache = None):
+    key = (url, start, length)
+    headers = cache.request_headers(key) if cache is not None else None
+    resp = get_http_session().get(url = url, params = event_list_params(start, length),
+        headers = headers, timeout = FETCH_TIMEOUT)
+    logging.debug('%s %s' % (resp.status_code, resp.url))
+    digest = None
+    if cache is not None:
+        digest = hashlib.sha1(resp.content).hexdigest()
+        page = cache.lookup(key, resp, digest)
+        if page is not None:
+            return page, True
+    # Every backend raises a ValueError subclass on a malformed body
     try:
-        return resp.json()
-    except Exception as error:
+        page = decode_event_list(resp.content)
+    except ValueError:
         logging.error(resp.text)
+        return None, False
+    if cache is not None:
+        cache.store(key, resp, digest, page)
+    return page, False
+
+
+# Fetches every page of the event list. Pages after the first are fetched in parallel and
+# merged in page order. Returns None if any page fails so that a partial list is never used.
+# With a FetchCache the response is flagged 'unchanged' when every page was a cache hit
+def makerequest(url = None, page_size = None, cache = None):
+    url = url or EVENT_LIST_URL
+    page_size = page_size or PAGE_SIZE
+    first, cached = fetch_page(url, 0, page_size, cache)
+    if first is None:
+        return None
+    total = first.get('recordsFiltered', first.get('recordsTotal', 0))
+    starts = list(range(page_size, total, page_size))
+    results = [(first, cached)] + list(get_fetch_pool().map(
+        lambda start: fetch_page(url, start, page_size, cache), starts))
+    if any(page is None for page, cached in results):
         return None
+    if cache is not None and all(cached for page, cached in results):
+        previous = cache.responses.get((url, page_size))
+        if previous is not None and previous['pages'] == len(results):
+            return dict(previous['response'], unchanged = True)
+    pages = [page for page, cached in results]
+    # Rows can shift between pages while we fetch them. Keep the first occurrence of every id
+    seen = set()
+    data = []
+    for page in pages:
+        for row in page['data']:
+            if row[5] not in seen:
+                seen.add(row[5])
+                data.append(row)
+    response = {
+        'recordsTotal': first.get('recordsTotal', len(data)),
+        'recordsFiltered': total,
+        'data': data
+    }
+    if cache is not None:
+        cache.responses[(url, page_size)] = { 'pages': len(pages), 'response': response }
+    return response
+
+
+# Raises ValueError for rows that cannot be parsed
+def parse_hike(row):
+    if len(row) < 6:
+        raise ValueError('Expected 6 columns in row %r' % (row,))
+    return Hike(int(row[5]), row[1], DIFFICULTIES.get(row[2], Difficulty.T0), row[3],
+        parse_date_string(row[4]))
+
+
+# Returns the loads function of the first installed JSON backend
+def get_json_loads():
+    global __json_loads__
+    if __json_loads__ is None:
+        forced = os.environ.get('HBM_JSON_BACKEND')
+        for name in ([forced] if forced else JSON_BACKENDS):
+            try:
+                __json_loads__ = importlib.import_module(name).loads
+                logging.info("decoding JSON with %s" % name)
+                break
+            except ImportError:
+                continue
+        else:
+            raise ImportError('No JSON backend available from %s' % ([forced] if forced else JSON_BACKENDS))
+    return __json_loads__
+
+
+def decode_event_list(content):
+    return get_json_loads()(content)
+
+
+# Yields the rows of an event list read from a file-like object. With ijson installed rows are
+# decoded one at a time without materialising the whole response. The fetcher does not use it:
+# FetchCache hashes and keeps every page anyway, so pages are decoded whole
+def iter_event_rows(fp):
+    if ijson is not None:
+        for row in ijson.items(fp, 'data.item'):
+            yield row
+    else:
+        for row in decode_event_list(fp.read())['data']:
+            yield row
+
+
+# Compact hike records shared with other processes: a header struct followed by the utf-8 name
+# and organiser. Dates are stored as their timestamp
+def pack_hike(hike):
+    name = hike.name.encode('utf-8')
+    organiser = hike.organiser.encode('utf-8')
+    return HIKE_RECORD.pack(hike.id, hike.timestamp, hike.difficulty.value, len(name), len(organiser)) + \
+        name + organiser
+
+
+# Yields the hikes packed in buffer[offset:end]. Records of hikes with ids up to min_id are
+# skipped without decoding their strings
+def unpack_hikes(buffer, offset = 0, end = None, min_id = 0):
+    end = len(buffer) if end is None else end
+    while offset < end:
+        hike_id, timestamp, level, name_length, organiser_length = HIKE_RECORD.unpack_from(buffer, offset)
+        if hike_id > min_id:
+            yield unpack_hike(buffer, offset)
+        offset += HIKE_RECORD.size + name_length + organiser_length
+
+
+# The hike of the record at offset
+def unpack_hike(buffer, offset):
+    hike_id, timestamp, level, name_length, organiser_length = HIKE_RECORD.unpack_from(buffer, offset)
+    offset += HIKE_RECORD.size
+    name = bytes(buffer[offset:offset + name_length]).decode('utf-8')
+    organiser = bytes(buffer[offset + name_length:offset + name_length + organiser_length]).decode('utf-8')
+    return Hike(hike_id, name, Difficulty(level), organiser, EPOCH + timedelta(seconds = timestamp))
+
+
+# Archive partition of a date as yyyy-mm
+def archive_month(date):
+    return '%04d-%02d' % (date.year, date.month)
+
+
+# Written next to the final file and renamed over it, so readers always map a complete snapshot
+def write_snapshot_file(path, snapshot):
+    hikes = snapshot.store.hikes
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, snapshot.generation, snapshot.latest_id, len(hikes)))
+        fp.write(b''.join(pack_hike(hike) for hike in hikes))
+    os.replace(path + '.tmp', path)
+
+
+# Returns (generation, latest_id, hikes with an id above min_id)
+def read_snapshot_file(path, min_id = 0):
+    with open(path, 'rb') as fp:
+        with closing(mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)) as buffer:
+            magic, generation, latest_id, count = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('%s is not a hikes snapshot' % path)
+            return generation, latest_id, list(unpack_hikes(buffer, SNAPSHOT_HEADER.size, min_id = min_id))
+
+
+def subscription_from_row(row):
+    return {
+        'id': row[0],
+        'chat_id': row[1],
+        'name': row[2],
+        'command': json.loads(row[3], object_hook = as_enum),
+        'last_id': row[4]
+    }
+
+
+# Publishes the hikes of a refresh together with the changeset that produced them
+def publish_hikes(hikes, changes):
+    global __snapshot__
+    previous = __snapshot__
+    latest_id = previous.latest_id
+    for hike in changes.added:
+        latest_id = hike.id if latest_id < hike.id else latest_id
+    # Only hikes that changed are rendered again
+    lines = dict(previous.lines)
+    for hike in changes.removed:
+        lines.pop(hike.id, None)
+    for hike in changes.added + changes.updated:
+        lines[hike.id] = render_hike(hike)
+    ## put the indexed result in the global variable. The new generation invalidates every
+    ## cached query of the previous data
+    store = HikeStore(hikes)
+    # Built here so that inline queries on the new data never wait for it
+    store.search
+    __snapshot__ = HikesSnapshot(store, lines, latest_id, previous.generation + 1)
+    logging.info("published %d hikes (%d added, %d updated, %d removed)" %
+        (len(hikes), len(changes.added), len(changes.updated), len(changes.removed)))
 
 
 def command_to_str(command):
@@ -233,6 +2128,9 @@ def command_to_str(command):
             return "eventsweek %s %s" % (command['diff_lo'], command['diff_hi'])
         elif command['command'] == "eventsorganiser":
             return "eventsorganiser %s" % command['organiser']
+        elif command['command'] == "eventsdate":
+            return ("eventsdate %s %s %s" % (command['date_from'] or '-', command['date_to'] or '-',
+                ','.join(DAYS[weekday][:3] for weekday in command['weekdays'] or []))).rstrip()
         else:
             return "invalid command"
     else:
@@ -261,9 +2159,12 @@ def get_date_string(hike_dt):
         (DAYS[hike_dt.weekday()], hike_dt.day, hike_dt.month, hike_dt.hour, hike_dt.minute)
 
 
+# Dates repeat a lot between rows and refreshes and datetimes are immutable, so results are cached
+@lru_cache(maxsize = DATE_CACHE_SIZE)
 def parse_date_string(web_date):
+    if not DATE_PATTERN.match(web_date):
+        raise ValueError('Invalid date %r' % web_date)
     date_arr = web_date.split(',')
-    ## TODO: Add verification of input
     # weekday = int(date_arr[0])
     day = int(date_arr[1])
     month = int(date_arr[2])
@@ -273,48 +2174,169 @@ def parse_date_string(web_date):
     return datetime(year, month, day, hour, minute)
 
 
-def is_valid_difficulty(lo, hi, actual):
+# Numeric difficulty values lo..hi, both inclusive. Defaults to T1..T6
+def difficulty_bounds(lo, hi):
     if lo is None:
         # set to lowest
         lo = Difficulty.T1
     if hi is None:
         # set to highest
         hi = Difficulty.T6
-    return (actual.value >= lo.value) and (actual.value <= hi.value)
+    return lo.value, hi.value
+
+
+def difficulty_range(lo, hi):
+    lo, hi = difficulty_bounds(lo, hi)
+    return [difficulty for difficulty in Difficulty if lo <= difficulty.value <= hi]
+
+
+# Dates are compared as seconds. Only the order matters so naive datetimes are taken as UTC
+@lru_cache(maxsize = DATE_CACHE_SIZE)
+def to_timestamp(dt):
+    return calendar.timegm(dt.timetuple())
+
+
+# (start, end) positions in sorted timestamps with date_from <= date < date_to
+def position_range(timestamps, date_from, date_to):
+    start = 0 if date_from is None else bisect.bisect_left(timestamps, to_timestamp(date_from))
+    end = len(timestamps) if date_to is None else bisect.bisect_left(timestamps, to_timestamp(date_to))
+    return start, end
+
+
+# Lowercase words without accents, separated by single spaces
+def normalize_search_text(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return SEARCH_SEPARATORS.sub(' ', text).strip()
+
+
+# Trigrams of space padded words. A partial last word is only padded at its start
+def search_trigrams(words, partial = False):
+    grams = []
+    for index, word in enumerate(words):
+        padded = ' %s' % word if partial and index == len(words) - 1 else ' %s ' % word
+        grams.extend(padded[start:start + 3] for start in range(len(padded) - 2))
+    return grams
+
+
+# Most hikes are unchanged between two refreshes, so rebuilding the index mostly hits this cache
+@lru_cache(maxsize = SEARCH_CACHE_SIZE)
+def hike_trigrams(name, organiser):
+    return frozenset(search_trigrams(normalize_search_text('%s %s' % (name, organiser)).split()))
+
+
+# Splits an inline query into search words and T<n> difficulty filters. The returned key is
+# the same for queries that search for the same thing and is used to cache their answers
+def parse_inline_query(query):
+    tokens = normalize_search_text(query).split()
+    words = []
+    difficulties = set()
+    for token in tokens:
+        difficulty = DIFFICULTIES.get(token.upper())
+        if difficulty is not None:
+            difficulties.add(difficulty.value)
+        else:
+            words.append(token)
+    # Only the last word can still be typed, and not if it was a difficulty
+    partial = bool(words) and tokens[-1] == words[-1] and not query[-1].isspace()
+    key = '%s%s|%s' % (' '.join(words), '*' if partial else '', ','.join(map(str, sorted(difficulties))))
+    return key, words, partial, difficulties or None
+
+
+def inline_result(hike, lines):
+    return InlineQueryResultArticle(
+        id = str(hike.id),
+        title = hike.name,
+        description = '%s  %s  %s' % (hike.difficulty.name, hike.date_string, hike.organiser),
+        url = hike.link,
+        input_message_content = InputTextMessageContent(lines.get(hike.id) or render_hike(hike),
+            parse_mode = ParseMode.MARKDOWN, disable_web_page_preview = True)
+    )
+
+
+def render_hike(hike):
+    return "*%4s.*  [%25s](%s)  %3s  __%15s__  %15s" % \
+        (hike.id, hike.name.replace('[', '<').replace(']', '>'), 
+            hike.link, hike.difficulty.name, hike.organiser, hike.date_string)
+
+
+# Renders hikes into messages under the size limit, split at line boundaries. The header
+# goes at the top of the first message
+def render_hikes(hikes, response = "", lines = None):
+    if lines is None:
+        lines = __snapshot__.lines
+    texts = [response.rstrip('\n')] if response else []
+    texts.extend([lines.get(hike.id) or render_hike(hike) for hike in hikes])
+    return coalesce_messages(texts)
+
+
+# Packs texts into as few messages under the size limit as possible, keeping their order.
+# A single text over the limit is cut into pieces, at a line break or space where possible so
+# that Markdown entities are not split
+def coalesce_messages(texts, limit = MESSAGE_LIMIT):
+    messages = []
+    current = []
+    size = 0
+    for text in texts:
+        if len(text) > limit and current:
+            messages.append('\n'.join(current))
+            current = []
+            size = 0
+        while len(text) > limit:
+            cut = text.rfind('\n', 0, limit + 1)
+            if cut <= 0:
+                cut = text.rfind(' ', 0, limit + 1)
+            if cut <= 0:
+                messages.append(text[:limit])
+                text = text[limit:]
+            else:
+                # The separator is dropped
+                messages.append(text[:cut])
+                text = text[cut + 1:]
+        if current and size + 1 + len(text) > limit:
+            messages.append('\n'.join(current))
+            current = []
+            size = 0
+        size += len(text) + (1 if current else 0)
+        current.append(text)
+    if current:
+        messages.append('\n'.join(current))
+    return messages
 
 
 def send_message(bot, chat_id, hikes, response = ""):
-    for hike in hikes:
-        response +=  "*%4s.*  [%25s](%s)  %3s  __%15s__  %15s\n" % \
-            (hike['id'], hike['name'].replace('[', '<').replace(']', '>'), 
-                hike['link'], hike['difficulty'].name, hike['organiser'], get_date_string(hike['date']))
-    if len(response) > 0:
-        bot.send_message(
-            parse_mode = ParseMode.MARKDOWN,
-            chat_id = chat_id,
-            text = response,
-            disable_web_page_preview = True
-        )
-    else:
-        bot.send_message(
-            chat_id = chat_id,
-            text = "No matching hikes found!"
-        )
+    send_pages(bot, chat_id, render_hikes(hikes, response))
+
+
+def get_hike_store(store = None):
+    if store is None:
+        store = __snapshot__.store
+    return store
 
 
-def get_eventsall():
-    return __hikes_data__
+def get_eventsall(store = None):
+    return get_hike_store(store).hikes
 
 
-def get_eventsweek(diff_low, diff_hi):
-    today = datetime.now()
-    next_monday = next_weekday(today, 0)
-    return [ hike for hike in __hikes_data__
-        if hike['date'] < next_monday and is_valid_difficulty(diff_low, diff_hi, hike['difficulty']) ]
+# Midnight of the coming Monday so that the whole of Sunday is included
+def week_end(today):
+    return next_weekday(today, 0).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
 
 
-def get_eventsorganiser(name):
-    return [ hike for hike in __hikes_data__ if name.lower() in hike['organiser'].lower() ]
+def get_eventsweek(diff_low, diff_hi, store = None):
+    return get_hike_store(store).query(date_to = week_end(datetime.now()), diff_lo = diff_low, diff_hi = diff_hi)
+
+
+def get_eventsorganiser(name, store = None):
+    return get_hike_store(store).query(organiser = name)
+
+
+# date_from and date_to are yyyy-mm-dd strings or None. date_to includes the whole day
+def get_eventsdate(date_from, date_to, weekdays = None, store = None):
+    return get_hike_store(store).query(
+        date_from = datetime.strptime(date_from, '%Y-%m-%d') if date_from else None,
+        date_to = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(1) if date_to else None,
+        weekdays = weekdays)
 
 
 def parse_command(command, args):
@@ -340,11 +2362,129 @@ def parse_command(command, args):
             }
         else:
             result = { 'valid': False, 'reason': 'organiser must be present' }
+    elif command == "eventsdate":
+        result = parse_date_range(args)
     else:
         result = { 'valid': False, 'reason': 'Unknown command ' + command }
     return result
 
 
+# Parses <startDate> [<endDate> [<weekdays>]] where dates are dd.mm or dd.mm.yyyy, or - for an
+# open end. The end date is inclusive and weekdays is a comma separated list such as sat,sun.
+# Dates are kept as yyyy-mm-dd strings so that the command can be stored with a subscription
+def parse_date_range(args, today = None):
+    today = (today or datetime.now()).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    date_reason = 'Dates must be of the format dd.mm or dd.mm.yyyy, or - for an open range'
+    if len(args) == 0 or len(args) > 3:
+        return { 'valid': False, 'reason': 'Usage: /eventsdate <startDate> <endDate> <weekdays>' }
+    # (day, month, year) of both ends, year None when it was left out
+    parts = []
+    for arg in args[:2]:
+        if arg == '-':
+            parts.append(None)
+            continue
+        fields = arg.split('.')
+        if len(fields) not in (2, 3) or not all(field.isdigit() for field in fields):
+            return { 'valid': False, 'reason': date_reason }
+        if len(fields) == 3 and (len(fields[2]) != 4 or int(fields[2]) < MIN_YEAR):
+            return { 'valid': False, 'reason': date_reason }
+        parts.append((int(fields[0]), int(fields[1]), int(fields[2]) if len(fields) == 3 else None))
+    if len(parts) == 1:
+        parts.append(None)
+    dates = [None, None]
+    try:
+        # Without a year the start is in the current year, unless it is clearly in the past
+        if parts[0] is not None:
+            day, month, year = parts[0]
+            dates[0] = datetime(year or today.year, month, day)
+            if year is None and dates[0] < today - timedelta(PAST_START_DAYS):
+                dates[0] = datetime(today.year + 1, month, day)
+        # Without a year the end is the first such day on or after the start
+        if parts[1] is not None:
+            day, month, year = parts[1]
+            reference = dates[0] or today
+            dates[1] = datetime(year or reference.year, month, day)
+            if year is None and dates[1] < reference:
+                dates[1] = datetime(reference.year + 1, month, day)
+    except ValueError:
+        return { 'valid': False, 'reason': date_reason }
+    if dates[0] is not None and dates[1] is not None and dates[1] < dates[0]:
+        return { 'valid': False, 'reason': 'The end date must not be before the start date' }
+    weekdays = None
+    if len(args) > 2:
+        names = [day[:3].lower() for day in DAYS]
+        weekdays = []
+        for name in args[2].lower().split(','):
+            if name[:3] not in names:
+                return { 'valid': False, 'reason': 'Weekdays must be a list such as sat,sun' }
+            weekdays.append(names.index(name[:3]))
+        weekdays = sorted(set(weekdays))
+    return {
+        'valid': True,
+        'command': 'eventsdate',
+        'date_from': format_date(dates[0]),
+        'date_to': format_date(dates[1]),
+        'weekdays': weekdays
+    }
+
+
+# yyyy-mm-dd as stored in commands. strftime does not pad years before 1000 everywhere
+def format_date(date):
+    return '%04d-%02d-%02d' % (date.year, date.month, date.day) if date is not None else None
+
+
+# Parses [<startMonth> [<endMonth>]] where months are mm.yyyy, or - for an open end, into
+# yyyy-mm strings. Without arguments the range starts ARCHIVE_DEFAULT_MONTHS - 1 months before
+# the current one and is open ended, so planned hikes are counted too
+def parse_month_range(args, today = None):
+    today = today or datetime.now()
+    month_reason = 'Months must be of the format mm.yyyy, or - for an open range'
+    if len(args) > 2:
+        return { 'valid': False, 'reason': 'Usage: /historymonths <startMonth> <endMonth>' }
+    if len(args) == 0:
+        start = today.year * 12 + today.month - ARCHIVE_DEFAULT_MONTHS
+        return { 'valid': True, 'month_from': '%04d-%02d' % (start // 12, start % 12 + 1), 'month_to': None }
+    months = []
+    for arg in args:
+        if arg == '-':
+            months.append(None)
+            continue
+        parts = arg.split('.')
+        try:
+            if len(parts) != 2:
+                return { 'valid': False, 'reason': month_reason }
+            month = datetime(int(parts[1]), int(parts[0]), 1)
+        except ValueError:
+            return { 'valid': False, 'reason': month_reason }
+        months.append(archive_month(month))
+    if len(months) == 1:
+        months.append(None)
+    if months[0] is not None and months[1] is not None and months[1] < months[0]:
+        return { 'valid': False, 'reason': 'The end month must not be before the start month' }
+    return { 'valid': True, 'month_from': months[0], 'month_to': months[1] }
+
+
+# Archived hikes span years, so a line with the year goes before the hikes of every year
+def render_history(hikes):
+    texts = []
+    year = None
+    for hike in hikes:
+        if hike.date.year != year:
+            year = hike.date.year
+            texts.append('*%d*' % year)
+        texts.append(render_hike(hike))
+    return coalesce_messages(texts)
+
+
+# A table of the number of hikes by difficulty per month, in code blocks so the columns line up
+def render_month_counts(counts):
+    lines = ['Month   ' + ' '.join('%3s' % difficulty.name for difficulty in Difficulty) + ' Total']
+    for month, levels in counts:
+        lines.append('%s ' % month + ' '.join('%3d' % levels.get(difficulty.value, 0) for difficulty in Difficulty) +
+            ' %5d' % sum(levels.values()))
+    return ['```\n%s\n```' % page for page in coalesce_messages(lines, MESSAGE_LIMIT - 8)]
+
+
 def parse_subscription_command(args):
     result = { 'valid': True }
     if len(args) > 0 and "list" == args[0]:
@@ -382,14 +2522,46 @@ def parse_difficulty(args):
     return result
 
 
-def execute_command(command):
+def subscription_key(command):
+    # Canonical key of a parsed command. Subscriptions sharing a key run the same query
+    return command_to_str(command)
+
+
+def evaluate_subscriptions(subscriptions, snapshot = None):
+    # Evaluates each distinct subscription command once and yields (subscription, new_hikes)
+    # for every subscription whose command is valid
+    groups = dict()
+    for subscription in subscriptions:
+        key = subscription_key(subscription['command'])
+        groups.setdefault(key, []).append(subscription)
+    for key, group in groups.items():
+        try:
+            result = execute_command_cached(group[0]['command'], snapshot)
+        except Exception:
+            logging.exception("Evaluating subscription command %s failed" % key)
+            continue
+        # We ignore invalid results
+        if not result['valid']:
+            continue
+        hikes = sorted(result['result'], key = lambda hike: hike.id)
+        ids = [hike.id for hike in hikes]
+        for subscription in group:
+            start = bisect.bisect_right(ids, subscription['last_id'])
+            yield subscription, hikes[start:]
+
+
+def execute_command(command, snapshot = None):
+    store = (snapshot or __snapshot__).store
     if command['valid']:
         if command['command'] == "eventsall":
-            return { 'result': get_eventsall(), 'valid': True }
+            return { 'result': get_eventsall(store), 'valid': True }
         elif command['command'] == "eventsweek":
-            return { 'result': get_eventsweek(command['diff_lo'], command['diff_hi']), 'valid': True }
+            return { 'result': get_eventsweek(command['diff_lo'], command['diff_hi'], store), 'valid': True }
         elif command['command'] == "eventsorganiser":
-            return { 'result': get_eventsorganiser(command['organiser']), 'valid': True }
+            return { 'result': get_eventsorganiser(command['organiser'], store), 'valid': True }
+        elif command['command'] == "eventsdate":
+            return { 'result': get_eventsdate(command['date_from'], command['date_to'],
+                command['weekdays'], store), 'valid': True }
         else:
             return {'valid': False, 'reason': 'unknown command'}
     else:
@@ -397,6 +2569,180 @@ def execute_command(command):
         return command
 
 
+# Tells if a single hike is in the result of a valid command, as execute_command would find it
+def command_matches(command, hike, now = None):
+    now = now or datetime.now()
+    if command['command'] == "eventsall":
+        return True
+    elif command['command'] == "eventsweek":
+        if hike.timestamp >= to_timestamp(week_end(now)):
+            return False
+        if command['diff_lo'] is None and command['diff_hi'] is None:
+            return True
+        lo, hi = difficulty_bounds(command['diff_lo'], command['diff_hi'])
+        return lo <= hike.difficulty.value <= hi
+    elif command['command'] == "eventsorganiser":
+        return command['organiser'].lower() in hike.organiser.lower()
+    elif command['command'] == "eventsdate":
+        if command['date_from'] and \
+                hike.timestamp < to_timestamp(datetime.strptime(command['date_from'], '%Y-%m-%d')):
+            return False
+        if command['date_to'] and \
+                hike.timestamp >= to_timestamp(datetime.strptime(command['date_to'], '%Y-%m-%d') + timedelta(1)):
+            return False
+        return command['weekdays'] is None or hike.date.weekday() in command['weekdays']
+    return False
+
+
+def get_query_cache():
+    global __query_cache__
+    if __query_cache__ is None:
+        __query_cache__ = QueryCache()
+    return __query_cache__
+
+
+# Time at which the result of a command may change without the data changing
+def command_expiry(command, now):
+    if command['command'] == "eventsweek":
+        return week_end(now)
+    return None
+
+
+# execute_command backed by the query cache
+def execute_command_cached(command, snapshot = None):
+    if not command['valid']:
+        return command
+    snapshot = snapshot or __snapshot__
+    now = datetime.now()
+    key = ('result', subscription_key(command), snapshot.generation)
+    cache = get_query_cache()
+    result = cache.get(key, now)
+    if result is None:
+        result = execute_command(command, snapshot)
+        if result['valid']:
+            cache.put(key, result, len(result['result']), command_expiry(command, now))
+    return result
+
+
+# Rendered message pages of a command backed by the query cache
+def render_command(command):
+    snapshot = __snapshot__
+    result = execute_command_cached(command, snapshot)
+    if not result['valid']:
+        return result
+    now = datetime.now()
+    key = ('pages', subscription_key(command), snapshot.generation)
+    cache = get_query_cache()
+    pages = cache.get(key, now)
+    if pages is None:
+        pages = render_hikes(result['result'], lines = snapshot.lines)
+        cache.put(key, pages, len(result['result']), command_expiry(command, now))
+    return { 'result': pages, 'valid': True }
+
+
+def send_pages(bot, chat_id, pages):
+    if len(pages) > 0:
+        for page in pages:
+            bot.send_message(
+                parse_mode = ParseMode.MARKDOWN,
+                chat_id = chat_id,
+                text = page,
+                disable_web_page_preview = True
+            )
+    else:
+        bot.send_message(
+            chat_id = chat_id,
+            text = "No matching hikes found!"
+        )
+
+
+def send_command(bot, chat_id, command):
+    rendered = render_command(command)
+    if rendered['valid']:
+        send_pages(bot, chat_id, rendered['result'])
+    else:
+        bot.send_message(chat_id = chat_id, text = rendered['reason'])
+
+
+# Main function of a notification shard process. Waits for new snapshots and subscription
+# changes, matches the new hikes against the subscriptions of the shard and sends the
+# notifications. Advanced last_ids are reported back to the coordinating process
+def run_notification_shard(shard, shards, snapshot_path, database, generation, subscriptions_version,
+        wake, stopping, results, bot_factory, send_rate):
+    global __outbox__, __snapshot__
+    # The coordinating process decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot = bot_factory()
+    if send_rate:
+        __outbox__ = OutboundQueue(bot, global_rate = send_rate)
+        __outbox__.start()
+    seen_generation = 0
+    seen_version = None
+    # Hikes up to the watermark were matched before, eg: by the previous run
+    latest_id = load_notified_id(database)
+    while not stopping.is_set():
+        # Cleared before looking for changes so that a wake up during the work is not lost
+        wake.clear()
+        sent = NOTIFICATIONS.labels()[0]
+        caught_up = False
+        if subscriptions_version.value != seen_version:
+            seen_version = subscriptions_version.value
+            added = load_shard_subscriptions(database, shard, shards)
+            # Hikes published while the new subscriptions were queued were not matched
+            # against them. Until the first snapshot was seen they catch up with it below
+            if added and seen_generation > 0:
+                try:
+                    published, latest, hikes = read_snapshot_file(snapshot_path)
+                    notify_pending_hikes(bot, added, HikesSnapshot(HikeStore(hikes), __snapshot__.lines,
+                        latest, published))
+                except Exception:
+                    logging.exception("Catching up subscriptions of shard %d failed" % shard)
+                caught_up = True
+        if generation.value != seen_generation:
+            published, latest, hikes = read_snapshot_file(snapshot_path, latest_id)
+            # Every new hike is rendered once for all the notifications that include it
+            __snapshot__ = __snapshot__._replace(lines = dict((hike.id, render_hike(hike)) for hike in hikes),
+                latest_id = latest, generation = published)
+            try:
+                notify_new_hikes(bot, hikes, latest)
+            except Exception:
+                logging.exception("Notifying new hikes on shard %d failed" % shard)
+            seen_generation = published
+            latest_id = max(latest_id, latest)
+            caught_up = True
+        if caught_up:
+            advances = dict()
+            while not __subscription_queue__.empty():
+                record = __subscription_queue__.get(block = False)
+                advances[record['id']] = max(advances.get(record['id'], 0), record['last_id'])
+            results.put((shard, seen_generation, advances, NOTIFICATIONS.labels()[0] - sent))
+        wake.wait(SHARD_POLL_INTERVAL)
+    if __outbox__ is not None:
+        __outbox__.stop(2)
+
+
+# Loads the subscriptions of a shard from the database. A last_id advanced by this process is
+# kept even if the coordinator has not written it yet. Returns the ids of subscriptions that are
+# new or whose command changed
+def load_shard_subscriptions(database, shard, shards):
+    with closing(sqlite3.connect(database)) as conn:
+        conn.execute(CREATE_SUBSCRIPTIONS)
+        rows = conn.execute(SELECT_SHARD_SUBSCRIPTIONS, (shards, shard)).fetchall()
+    current = __subscriptions__.current()
+    subscriptions = dict()
+    added = []
+    for row in rows:
+        subscription = subscription_from_row(row)
+        previous = current.get(subscription['id'])
+        if previous is None or previous['command'] != subscription['command']:
+            added.append(subscription['id'])
+        elif previous['last_id'] > subscription['last_id']:
+            subscription['last_id'] = previous['last_id']
+        subscriptions[subscription['id']] = subscription
+    __subscriptions__.replace(subscriptions)
+    return added
+
+
 ## End Helper functions
 
 ## Begin command functions
@@ -413,46 +2759,52 @@ def start(bot, update):
                     eg: /eventsDate
             5. /eventsorganiser <organiser name>: List all events by organiser
                     eg: /eventsorganiser Amit
-            6. /eventsdate <startDate> <endDate>: List all events within specified date | Unimplemented
-            7. /subscribe <subscription name> <command> <command args>: Subscribe to a command from 1-5. Get a 
+            6. /eventsdate <startDate> <endDate> <weekdays>: List all events between two dates (dd.mm or
+                    dd.mm.yyyy, - for an open end), optionally only on some weekdays
+                    eg: /eventsdate 01.06 30.06 sat,sun
+            7. /subscribe <subscription name> <command> <command args>: Subscribe to a command from 1-6. Get a 
                     notification everytime a new hike appears for that command. 
                     eg: /subscribe hikes_above_t4 eventsweek T4
             8. /subscribe list: List current subscriptions
-            9. /subscribe remove <subscription name>: Remove subscription name"""
+            9. /subscribe remove <subscription name>: Remove subscription name
+            10. /historyorganiser <organiser name>: List the latest archived events by organiser, past ones included
+                    eg: /historyorganiser Amit
+            11. /historymonths <startMonth> <endMonth>: Count archived events per month by difficulty (mm.yyyy,
+                    - for an open end). Defaults to the last 12 months
+                    eg: /historymonths 01.2024 12.2024"""
     bot.send_message(chat_id=update.message.chat_id, text=help_string)
 
 
 def eventsall(bot, update):
-    logging.info("handling all events")
-    send_message(bot, update.message.chat_id, get_eventsall())
+    logging.debug("handling all events")
+    send_command(bot, update.message.chat_id, parse_command('eventsall', []))
 
 
 def eventsweek(bot, update, args):
-    logging.info("handling eventsweek")
-    diff_result = parse_difficulty(args)
-    if diff_result['valid']:
-        send_message(bot, update.message.chat_id, get_eventsweek(diff_result['diff_lo'], diff_result['diff_hi']))
-    else:
-        bot.send_message(chat_id = update.message.chat_id, text = diff_result['reason'])
+    logging.debug("handling eventsweek")
+    send_command(bot, update.message.chat_id, parse_command('eventsweek', args))
+
+
+def eventsdate(bot, update, args):
+    logging.debug("handling eventsdate")
+    send_command(bot, update.message.chat_id, parse_command('eventsdate', args))
 
 
 def eventsorganiser(bot, update, args):
-    logging.info("handling eventsorganiser")
-    hikes = makerequest()['data']
+    logging.debug("handling eventsorganiser")
     if len(args) > 0:
-        name = ' '.join(args)
-        send_message(bot, update.message.chat_id, get_eventsorganiser(name))
+        send_command(bot, update.message.chat_id, parse_command('eventsorganiser', args))
     else:
         bot.send_message(chat_id = update.message.chat_id, text = "Please specify the organiser name.")
 
 
 def subscribe(bot, update, args):
-    logging.info("handling subscription")
+    logging.debug("handling subscription")
     parsed_command = parse_subscription_command(args)
     response = ""
     if parsed_command['valid']:
         if parsed_command['command'] == "list":
-            for subscription in __subscriptions__.values():
+            for subscription in __subscriptions__.current().values():
                 response += "%10s  %s\n" % (subscription['name'], command_to_str(subscription['command']))
             if response == "":
                 response = "No subscriptions found"
@@ -464,6 +2816,9 @@ def subscribe(bot, update, args):
                     'chat_id': update.message.chat_id
                 })
             response = "%s subscription removed" % parsed_command['subscription_name']
+        elif __snapshot__.generation == 0:
+            # Without hikes every existing event would look new to the subscription
+            response = "Hikes are still loading. Please try again in a moment"
         else: # Else this is a normal command. Add it to queue 
             subscription_name = parsed_command.pop('subscription_name')
             __subscription_queue__.put({
@@ -472,7 +2827,7 @@ def subscribe(bot, update, args):
                     'chat_id': update.message.chat_id,
                     'name': subscription_name,
                     'command': parsed_command,
-                    'last_id': __latest_hike_id__
+                    'last_id': __snapshot__.latest_id
                 })
             response = "%s subscription added" % subscription_name
     else:
@@ -480,46 +2835,212 @@ def subscribe(bot, update, args):
     bot.send_message(chat_id = update.message.chat_id, text = response)
 
 
+def historyorganiser(bot, update, args):
+    logging.debug("handling historyorganiser")
+    if __archive__ is None:
+        bot.send_message(chat_id = update.message.chat_id, text = "The archive is not enabled.")
+    elif len(args) > 0:
+        send_pages(bot, update.message.chat_id, render_history(__archive__.history(' '.join(args))))
+    else:
+        bot.send_message(chat_id = update.message.chat_id, text = "Please specify the organiser name.")
+
+
+def historymonths(bot, update, args):
+    logging.debug("handling historymonths")
+    parsed = parse_month_range(args)
+    if __archive__ is None:
+        bot.send_message(chat_id = update.message.chat_id, text = "The archive is not enabled.")
+    elif not parsed['valid']:
+        bot.send_message(chat_id = update.message.chat_id, text = parsed['reason'])
+    else:
+        counts = __archive__.counts(parsed['month_from'], parsed['month_to'])
+        send_pages(bot, update.message.chat_id, render_month_counts(counts) if counts else [])
+
+
+# Sends a subscription notification through the outbound queue when it is running
+def notify(bot, chat_id, hikes, header):
+    outbox = __outbox__
+    if outbox is not None:
+        for page in render_hikes(hikes, header):
+            outbox.put(chat_id, page)
+    else:
+        send_message(bot, chat_id, hikes, response = header)
+
+
+# Publishes and persists the new last_id of subscriptions that were notified
+def advance_subscriptions(advances):
+    __subscriptions__.advance(advances)
+    for subscription_id, last_id in advances.items():
+        __subscription_queue__.put({
+                'action': 'advance',
+                'id': subscription_id,
+                'last_id': last_id
+            })
+
+
+# Catches up every subscription with the hikes published since its last_id, eg: after a
+# restart. New hikes found by the HikesLoader are matched by notify_new_hikes instead
 def send_subscriptions(bot, job):
-    logging.info("sending subscriptions")
-    # We will execute commands only once
-    eventsall = None
-    eventsweek = dict()
-    eventsorganiser = dict()
-    # This is bad for now. If we have a lot of subscriptions we can start caching results
-    for subscription in __subscriptions__.values():
-        result = execute_command(subscription['command'])
-        # We ignore invalid results
-        if result['valid']:
-            hikes = [hike for hike in result['result'] if hike['id'] > subscription['last_id']]
+    logging.debug("sending subscriptions")
+    # Notification shards catch up with the first snapshot they receive
+    if __shards__ is not None:
+        return
+    snapshot = __snapshot__
+    notify_pending_hikes(bot, __subscriptions__.current().keys(), snapshot, load_notified_id())
+    record_notified(snapshot.latest_id)
+
+
+# Notifies the subscriptions with ids of the published hikes above their last_id. Each distinct
+# command is executed only once. Hikes up to notified_id were already matched against every
+# subscription, so they are skipped too: a subscription that matched none of them kept its old
+# last_id, and an eventsweek subscription would otherwise get them once they are in the week
+def notify_pending_hikes(bot, subscription_ids, snapshot = None, notified_id = 0):
+    snapshot = snapshot or __snapshot__
+    # Nothing to compare against until hikes have been loaded
+    if snapshot.generation == 0:
+        return
+    start = time.perf_counter()
+    advances = dict()
+    with __notify_lock__:
+        # Taken under the lock so that last_ids advanced by other notifications are seen
+        subscriptions = __subscriptions__.current()
+        pending = [subscriptions[subscription_id] for subscription_id in subscription_ids
+            if subscription_id in subscriptions]
+        if notified_id:
+            pending = [dict(subscription, last_id = max(subscription['last_id'], notified_id))
+                for subscription in pending]
+        for subscription, hikes in evaluate_subscriptions(pending, snapshot):
+            last_id = snapshot.latest_id
             # Only send if we found some hike
             if len(hikes) > 0:
-                send_message(bot, subscription['chat_id'], hikes, 
-                    response = "*Subscription: %s*\n" % subscription['name'])
-            __subscription_queue__.put({
-                    'action': 'add',
-                    'id': subscription['id'],
-                    'chat_id': subscription['chat_id'],
-                    'name': subscription['name'],
-                    'command': subscription['command'],
-                    'last_id': __latest_hike_id__
-                })
-    
-
-def inline(bot, update):
-    query = update.inline_query.query
-    if not query:
+                try:
+                    notify(bot, subscription['chat_id'], hikes, "*Subscription: %s*\n" % subscription['name'])
+                except Exception:
+                    logging.exception("Notifying subscription %s failed" % subscription['id'])
+                    continue
+                NOTIFICATIONS.inc()
+                last_id = max(last_id, hikes[-1].id)
+            # Only subscriptions that moved forward are written
+            if last_id > subscription['last_id']:
+                advances[subscription['id']] = last_id
+        advance_subscriptions(advances)
+    NOTIFY_SECONDS.observe(time.perf_counter() - start)
+
+
+# Persists that every subscription was matched against the hikes up to latest_id. Written by
+# the SubscriptionHandler, so subscriptions that matched nothing need no write of their own
+def record_notified(latest_id):
+    __subscription_queue__.put({
+            'action': 'notified',
+            'last_id': latest_id
+        })
+
+
+# Hikes up to this id were matched against every subscription. 0 before anything was notified
+def load_notified_id(database = None):
+    with closing(sqlite3.connect(database or DATABASE)) as conn:
+        conn.execute(CREATE_STATE)
+        state = conn.execute(SELECT_STATE, ('notified_id',)).fetchone()
+    return state[0] if state is not None else 0
+
+
+# Pushes hikes that were just published through the subscription index and notifies every
+# subscription they match. Only subscriptions with a match are touched, so a fetch without new
+# hikes costs nothing
+def notify_new_hikes(bot, hikes, latest_id):
+    if not hikes:
         return
-    query
-    results = list()
-    results.append(
-        InlineQueryResultArticle(
-            id=query.upper(),
-            title='Feature pending',
-            input_message_content=InputTextMessageContent("Sorry this feature is still pending")
-        )
-    )
-    bot.answer_inline_query(update.inline_query.id, results)
+    start = time.perf_counter()
+    now = datetime.now()
+    index = __subscriptions__.current_index()
+    matches = dict()
+    for hike in sorted(hikes, key = lambda hike: hike.id):
+        for key in index.match(hike, now):
+            matches.setdefault(key, []).append(hike)
+    advances = dict()
+    with __notify_lock__:
+        subscriptions = __subscriptions__.current()
+        for key, matched in matches.items():
+            # A failing group is logged and the others are still notified
+            try:
+                notify_group(bot, index.groups[key][1], subscriptions, matched, latest_id, advances)
+            except Exception:
+                logging.exception("Notifying subscription command %s failed" % key)
+        advance_subscriptions(advances)
+    NOTIFY_SECONDS.observe(time.perf_counter() - start)
+
+
+# Notifies the subscriptions of one command of the matched hikes above their last_id and
+# records how far they advanced
+def notify_group(bot, subscription_ids, subscriptions, matched, latest_id, advances):
+    ids = [hike.id for hike in matched]
+    for subscription_id in subscription_ids:
+        subscription = subscriptions.get(subscription_id)
+        if subscription is None:
+            continue
+        pending = matched[bisect.bisect_right(ids, subscription['last_id']):]
+        if pending:
+            notify(bot, subscription['chat_id'], pending, "*Subscription: %s*\n" % subscription['name'])
+            NOTIFICATIONS.inc()
+            advances[subscription_id] = max(latest_id, pending[-1].id)
+
+
+# Answers from the trigram index of the published hikes. Queries arrive on every keystroke so
+# answers are cached per normalised query until the hikes change
+def inline(bot, update):
+    snapshot = __snapshot__
+    key, words, partial, difficulties = parse_inline_query(update.inline_query.query)
+    cache = get_query_cache()
+    cache_key = ('inline', key, snapshot.generation)
+    results = cache.get(cache_key)
+    if results is None:
+        hikes = snapshot.store.search.search(words, partial, difficulties, INLINE_RESULTS_LIMIT)
+        results = [inline_result(hike, snapshot.lines) for hike in hikes]
+        cache.put(cache_key, results, len(results))
+    bot.answer_inline_query(update.inline_query.id, results, cache_time = INLINE_CACHE_TIME)
+
+
+# Wraps a handler callback to record its latency and failures under the command name
+def timed_handler(name, callback):
+    def handler(bot, update, **kwargs):
+        start = time.perf_counter()
+        try:
+            return callback(bot, update, **kwargs)
+        except Exception:
+            COMMAND_ERRORS.inc(labels = (name,))
+            raise
+        finally:
+            COMMAND_SECONDS.observe(time.perf_counter() - start, labels = (name,))
+    return handler
+
+
+def add_handlers(dispatcher):
+    # Define handlers
+    start_handler = CommandHandler('start', timed_handler('start', start))
+    help_handler = CommandHandler('help', timed_handler('help', start))
+    allevents_handler = CommandHandler('eventsall', timed_handler('eventsall', eventsall))
+    eventsweek_handler = CommandHandler('eventsweek', timed_handler('eventsweek', eventsweek), pass_args = True)
+    eventsorganiser_handler = CommandHandler('eventsorganiser',
+        timed_handler('eventsorganiser', eventsorganiser), pass_args = True)
+    eventsdate_handler = CommandHandler('eventsdate', timed_handler('eventsdate', eventsdate), pass_args = True)
+    subscribe_handler = CommandHandler('subscribe', timed_handler('subscribe', subscribe), pass_args = True)
+    historyorganiser_handler = CommandHandler('historyorganiser',
+        timed_handler('historyorganiser', historyorganiser), pass_args = True)
+    historymonths_handler = CommandHandler('historymonths', timed_handler('historymonths', historymonths),
+        pass_args = True)
+    inline_command_handler = InlineQueryHandler(timed_handler('inline', inline))
+    
+    # Add handlers to dispatcher
+    dispatcher.add_handler(start_handler)
+    dispatcher.add_handler(help_handler)
+    dispatcher.add_handler(allevents_handler)
+    dispatcher.add_handler(eventsweek_handler)
+    dispatcher.add_handler(eventsorganiser_handler)
+    dispatcher.add_handler(eventsdate_handler)
+    dispatcher.add_handler(subscribe_handler)
+    dispatcher.add_handler(historyorganiser_handler)
+    dispatcher.add_handler(historymonths_handler)
+    dispatcher.add_handler(inline_command_handler)
 ## End command functions
 
 
@@ -532,52 +3053,104 @@ if __name__ == "__main__":
         logging.error("Please set TELEGRAM_TOKEN in the environment")
         sys.exit(0)
 
-    updater = Updater(token=os.environ['TELEGRAM_TOKEN'])
+    # A missing JSON backend fails here instead of failing every fetch
+    try:
+        get_json_loads()
+    except ImportError as error:
+        logging.error(error)
+        sys.exit(1)
+
+    updater = Updater(token=os.environ['TELEGRAM_TOKEN'], base_url=TELEGRAM_API_URL)
     dispatcher = updater.dispatcher
     job_queue = updater.job_queue
 
     # Jobs
-    j1 = SubscriptionHandler(10)
-    j2 = HikesLoader(30)
+    j1 = SubscriptionHandler(10, bot = updater.bot)
+    j2 = HikesLoader(30, AdaptiveScheduler(30), updater.bot)
+    # Serve the last known hikes right away instead of waiting for the first fetch
+    j2.load_snapshot()
+
+    # Every published hike is kept in the archive, including the ones loaded from the snapshot
+    if ARCHIVE_DIR:
+        __archive__ = HikesArchive(ARCHIVE_DIR)
+        __archive__.seed(__snapshot__.store.hikes)
+
+    add_handlers(dispatcher)
+
+    # Subscription notifications are matched and sent by worker processes
+    if NOTIFY_SHARDS > 0:
+        __shards__ = NotificationShards(NOTIFY_SHARDS, BotFactory(os.environ['TELEGRAM_TOKEN'], TELEGRAM_API_URL))
+        __shards__.start()
+        if __snapshot__.generation > 0:
+            __shards__.publish(__snapshot__)
+
+    # Subscription notifications are delivered through a rate limited queue
+    __outbox__ = OutboundQueue(updater.bot)
+    __outbox__.start()
+
+    # Local metrics and profiling endpoint
+    if METRICS_PORT:
+        __metrics_server__ = MetricsServer(int(METRICS_PORT))
+        __metrics_server__.start()
+
+    if UPDATES_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            logging.error("Please set HBM_WEBHOOK_URL in the environment to receive updates by webhook")
+            sys.exit(0)
+        __webhook_server__ = WebhookServer(updater.bot, dispatcher, WEBHOOK_PORT, WEBHOOK_HOST,
+            urlparse(WEBHOOK_URL).path or '/', WEBHOOK_SECRET)
+        __webhook_server__.start()
+        __webhook_server__.register(WEBHOOK_URL)
+
+    if RUNTIME == 'async':
+        # Blocks until SIGINT or SIGTERM
+        AsyncRuntime(updater.bot, dispatcher, j2, j1, poll = __webhook_server__ is None).run()
+        if __webhook_server__ is not None:
+            __webhook_server__.stop()
+        __outbox__.stop(2)
+        if __shards__ is not None:
+            __shards__.stop(5)
+        if __metrics_server__ is not None:
+            __metrics_server__.stop()
+        sys.exit(0)
+
     j1.start()
     j2.start()
 
-    # Define handlers
-    start_handler = CommandHandler('start', start)
-    help_handler = CommandHandler('help', start)
-    allevents_handler = CommandHandler('eventsall', eventsall)
-    eventsweek_handler = CommandHandler('eventsweek', eventsweek, pass_args = True)
-    eventsorganiser_handler = CommandHandler('eventsorganiser', eventsorganiser, pass_args = True)
-    subscribe_handler = CommandHandler('subscribe', subscribe, pass_args = True)
-    inline_command_handler = InlineQueryHandler(inline)
-    
-    # Add handlers to dispatcher
-    dispatcher.add_handler(start_handler)
-    dispatcher.add_handler(help_handler)
-    dispatcher.add_handler(allevents_handler)
-    dispatcher.add_handler(eventsweek_handler)
-    dispatcher.add_handler(eventsorganiser_handler)
-    dispatcher.add_handler(subscribe_handler)
-    dispatcher.add_handler(inline_command_handler)
-
     ## Queued jobs
-    job_queue.run_repeating(callback = send_subscriptions, interval = 15)
+    # New hikes are notified by the loader right after a fetch. This only catches up
+    # subscriptions with hikes published while the bot was not running
+    job_queue.run_once(callback = send_subscriptions, when = 15)
 
-    # Start polling
-    updater.start_polling()
+    if __webhook_server__ is None:
+        # Start polling
+        updater.start_polling()
+    else:
+        # start_polling would start the job queue
+        job_queue.start()
 
     # For ending app
     def signal_handler(signal, frame):
         logging.info('Terminating program...')
         # Stop updater before exiting
+        if __webhook_server__ is not None:
+            logging.info("Stopping webhook")
+            __webhook_server__.stop()
         logging.info("Stopping updater")
         updater.stop()
         logging.info("Stopping subscription handler")
-        j1.shutdown_flag.set()
+        j1.stop()
         logging.info("Stopping hikes loader")
-        j2.shutdown_flag.set()
+        j2.stop()
         j1.join(2)
         j2.join(2)
+        logging.info("Stopping outbound queue")
+        __outbox__.stop(2)
+        if __shards__ is not None:
+            logging.info("Stopping notification shards")
+            __shards__.stop(5)
+        if __metrics_server__ is not None:
+            __metrics_server__.stop()
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
     forever = threading.Event()
@@ -0,0 +1,58 @@
+# The bot is a single module at the top of the repository and the fake servers live with the
+# benchmarks
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+import bot
+
+
+# Runs a test on empty published state and a throwaway database
+@pytest.fixture
+def clean_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'DATABASE', str(tmp_path / 'hbm.db'))
+    monkeypatch.setattr(bot, '__snapshot__', bot.HikesSnapshot(bot.HikeStore([]), dict(), 0, 0))
+    monkeypatch.setattr(bot, '__subscriptions__', bot.SubscriptionRegistry())
+    monkeypatch.setattr(bot, '__subscription_queue__', bot.Queue())
+    monkeypatch.setattr(bot, '__query_cache__', None)
+    monkeypatch.setattr(bot, '__outbox__', None)
+    monkeypatch.setattr(bot, '__shards__', None)
+    monkeypatch.setattr(bot, '__archive__', None)
+
+
+class RecordingBot(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+class Message(object):
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+
+class Update(object):
+
+    def __init__(self, chat_id):
+        self.message = Message(chat_id)
+
+
+# Bot that records the (chat id, text) of every message sent instead of sending it
+@pytest.fixture
+def recorder():
+    return RecordingBot()
+
+
+# Builds the part of an update that the command handlers read, eg. chat_update(5)
+@pytest.fixture
+def chat_update():
+    return Update
@@ -0,0 +1,49 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import bot
+
+pytestmark = pytest.mark.usefixtures('clean_state')
+
+
+def hike(hike_id, organiser, date, difficulty = bot.Difficulty.T2):
+    return bot.Hike(hike_id, 'Hike %d' % hike_id, difficulty, organiser, date)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return bot.HikesArchive(str(tmp_path / 'archive'))
+
+
+def test_history_and_counts(archive):
+    archive.record([hike(1, 'Anna', datetime(2024, 1, 5)), hike(2, 'Ben', datetime(2024, 1, 6), bot.Difficulty.T4),
+        hike(3, 'Anna', datetime(2024, 2, 5))])
+    assert [found.id for found in archive.history('ann')] == [1, 3]
+    assert archive.counts() == [('2024-01', { 2: 1, 4: 1 }), ('2024-02', { 2: 1 })]
+    assert archive.counts('2024-02') == [('2024-02', { 2: 1 })]
+
+
+def test_a_hike_moved_to_another_month_leaves_its_old_partition(archive):
+    archive.record([hike(1, 'Anna', datetime(2024, 1, 5))])
+    archive.record([hike(1, 'Anna', datetime(2024, 2, 5), bot.Difficulty.T5)])
+    assert archive.counts() == [('2024-01', {}), ('2024-02', { 5: 1 })]
+    assert [(found.id, found.difficulty) for found in archive.history('anna')] == [(1, bot.Difficulty.T5)]
+
+
+def test_a_torn_record_is_cut_off(archive):
+    archive.record([hike(1, 'Anna', datetime(2024, 1, 5))])
+    path = archive.partition_path('2024-01', 'dat')
+    size = os.path.getsize(path)
+    with open(path, 'ab') as fp:
+        fp.write(b'\x01\x02\x03')
+    archive.record([hike(2, 'Anna', datetime(2024, 1, 6))])
+    assert [found.id for found in archive.history('anna')] == [1, 2]
+    assert os.path.getsize(path) == 2 * size
+
+
+def test_history_commands_need_the_archive(recorder, chat_update):
+    bot.historymonths(recorder, chat_update(5), [])
+    bot.historyorganiser(recorder, chat_update(5), ['anna'])
+    assert recorder.messages == [(5, 'The archive is not enabled.')] * 2
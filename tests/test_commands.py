@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+TODAY = datetime(2026, 10, 18)
+DATE_REASON = 'Dates must be of the format dd.mm or dd.mm.yyyy, or - for an open range'
+
+
+def date_range(*args):
+    result = bot.parse_date_range(list(args), TODAY)
+    assert result['valid'], result
+    return result['date_from'], result['date_to']
+
+
+@pytest.mark.parametrize('arg', ['01.06.24', '01.06.024', '01.06.1899', '30.02', '1.2.3.4', 'a.b'])
+def test_parse_date_range_rejects_invalid_dates(arg):
+    assert bot.parse_date_range([arg], TODAY) == { 'valid': False, 'reason': DATE_REASON }
+
+
+def test_parse_date_range_keeps_a_range_of_the_current_month():
+    assert date_range('01.10', '31.10') == ('2026-10-01', '2026-10-31')
+
+
+def test_parse_date_range_keeps_a_recent_start():
+    assert date_range('15.10') == ('2026-10-15', None)
+
+
+def test_parse_date_range_moves_a_start_long_past_to_next_year():
+    assert date_range('01.01') == ('2027-01-01', None)
+
+
+def test_parse_date_range_puts_the_end_after_the_start():
+    assert date_range('01.12', '15.01') == ('2026-12-01', '2027-01-15')
+    assert date_range('01.06.2024', '01.05') == ('2024-06-01', '2025-05-01')
+
+
+def test_parse_date_range_rejects_an_end_before_the_start():
+    result = bot.parse_date_range(['01.06.2027', '01.05.2027'], TODAY)
+    assert not result['valid']
+
+
+def test_parse_date_range_stores_dates_that_get_eventsdate_reads():
+    command = bot.parse_date_range(['01.06.1950', '-', 'sat,sun'], TODAY)
+    assert command['date_from'] == '1950-06-01'
+    assert command['weekdays'] == [5, 6]
+    assert bot.get_eventsdate(command['date_from'], command['date_to'], command['weekdays'],
+        bot.HikeStore([])) == []
+
+
+def test_coalesce_messages_keeps_texts_in_order_around_a_cut_text():
+    messages = bot.coalesce_messages(['header', 'x' * 5000, 'tail'], limit = 4096)
+    assert messages == ['header', 'x' * 4096, 'x' * 904 + '\ntail']
+
+
+def test_coalesce_messages_cuts_long_texts_between_words():
+    words = ['*%d*' % number for number in range(1000)]
+    messages = bot.coalesce_messages([' '.join(words)], limit = 100)
+    assert all(len(message) <= 100 for message in messages)
+    assert ' '.join(messages).split() == words
+
+
+def test_coalesce_messages_packs_lines_under_the_limit():
+    messages = bot.coalesce_messages(['a' * 40] * 5, limit = 100)
+    assert messages == ['\n'.join(['a' * 40] * 2)] * 2 + ['a' * 40]
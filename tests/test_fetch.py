@@ -0,0 +1,125 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+import bot
+from common import make_rows
+from fakes import FakeUpstream
+
+
+@pytest.fixture
+def upstream():
+    server = FakeUpstream(make_rows(25)).start()
+    yield server
+    server.stop()
+
+
+def test_makerequest_merges_every_page(upstream):
+    response = bot.makerequest(upstream.url, page_size = 10)
+    assert [row[5] for row in response['data']] == [str(hike_id) for hike_id in range(1, 26)]
+    assert response['recordsFiltered'] == 25
+    assert upstream.requests == 3
+
+
+def test_makerequest_drops_rows_repeated_on_the_next_page(upstream):
+    rows = make_rows(25)
+    # A new row before the second page moves the last row of the first page onto it
+    upstream.set_rows(rows[:10] + [rows[9]] + rows[10:])
+    response = bot.makerequest(upstream.url, page_size = 10)
+    assert [row[5] for row in response['data']] == [str(hike_id) for hike_id in range(1, 26)]
+
+
+def test_makerequest_fails_when_a_page_fails(upstream):
+    upstream.failing_starts.add(20)
+    assert bot.makerequest(upstream.url, page_size = 10) is None
+
+
+def test_makerequest_fails_when_the_first_page_fails(upstream):
+    upstream.failing_starts.add(0)
+    assert bot.makerequest(upstream.url, page_size = 10) is None
+    assert upstream.requests == 1
+
+
+def saved_hike_ids():
+    with closing(bot.open_database()) as conn:
+        return sorted(int(key) for (key,) in conn.execute('SELECT id FROM hikes'))
+
+
+@pytest.mark.usefixtures('clean_state')
+def test_loader_publishes_an_empty_first_fetch(monkeypatch):
+    server = FakeUpstream([]).start()
+    try:
+        monkeypatch.setattr(bot, 'EVENT_LIST_URL', server.url)
+        bot.HikesLoader(30).task()
+    finally:
+        server.stop()
+    assert bot.__snapshot__.generation == 1
+    assert bot.__snapshot__.store.hikes == []
+
+
+@pytest.mark.usefixtures('clean_state')
+def test_loader_notifies_when_saving_fails_and_saves_everything_next_time(upstream, monkeypatch):
+    monkeypatch.setattr(bot, 'EVENT_LIST_URL', upstream.url)
+    notified = []
+    monkeypatch.setattr(bot, 'notify_new_hikes', lambda bot, hikes, latest_id: notified.append(len(hikes)))
+    loader = bot.HikesLoader(30, bot = object())
+    save_snapshot = loader.save_snapshot
+    def failing_save():
+        raise sqlite3.OperationalError('database is locked')
+    loader.save_snapshot = failing_save
+    loader.task()
+    assert notified == [25]
+    assert bot.__snapshot__.generation == 1
+    # Only one hike changes, but every hike is written as the previous save failed
+    loader.save_snapshot = save_snapshot
+    upstream.set_rows(make_rows(26))
+    loader.task()
+    assert notified == [25, 1]
+    assert saved_hike_ids() == list(range(1, 27))
+
+
+@pytest.fixture
+def etag_upstream():
+    server = FakeUpstream(make_rows(25), etags = True).start()
+    yield server
+    server.stop()
+
+
+def test_fetch_cache_hits_when_the_upstream_answers_not_modified(etag_upstream):
+    cache = bot.FetchCache()
+    first = bot.makerequest(etag_upstream.url, page_size = 10, cache = cache)
+    assert 'unchanged' not in first
+    assert (cache.hits, cache.misses) == (0, 3)
+    # A 304 has no body, so only the validators can have matched
+    second = bot.makerequest(etag_upstream.url, page_size = 10, cache = cache)
+    assert second['unchanged']
+    assert second['data'] == first['data']
+    assert cache.stats() == { 'hits': 3, 'misses': 3, 'hit_rate': 0.5 }
+
+
+def test_fetch_cache_hits_when_the_body_did_not_change(etag_upstream):
+    cache = bot.FetchCache()
+    bot.makerequest(etag_upstream.url, page_size = 10, cache = cache)
+    # New validators for the same rows: every page is downloaded but none is decoded again
+    etag_upstream.set_rows(make_rows(25))
+    assert bot.makerequest(etag_upstream.url, page_size = 10, cache = cache)['unchanged']
+    assert (cache.hits, cache.misses) == (3, 3)
+    etag_upstream.set_rows(make_rows(26))
+    response = bot.makerequest(etag_upstream.url, page_size = 10, cache = cache)
+    assert 'unchanged' not in response
+    assert len(response['data']) == 26
+
+
+@pytest.mark.usefixtures('clean_state')
+def test_loader_does_not_publish_unchanged_pages(etag_upstream, monkeypatch):
+    monkeypatch.setattr(bot, 'EVENT_LIST_URL', etag_upstream.url)
+    loader = bot.HikesLoader(30)
+    loader.task()
+    assert bot.__snapshot__.generation == 1
+    loader.task()
+    assert bot.__snapshot__.generation == 1
+    assert loader.fetch_cache.hits > 0
+    etag_upstream.set_rows(make_rows(26))
+    loader.task()
+    assert bot.__snapshot__.generation == 2
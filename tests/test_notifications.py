@@ -0,0 +1,102 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+from common import make_rows, publish_rows
+
+
+pytestmark = pytest.mark.usefixtures('clean_state')
+
+
+def subscription(chat_id, name, text, last_id):
+    words = text.split()
+    return {
+        'id': '%d_%s' % (chat_id, name),
+        'chat_id': chat_id,
+        'name': name,
+        'command': bot.parse_command(words[0], words[1:]),
+        'last_id': last_id
+    }
+
+
+def test_queued_subscription_is_caught_up_after_the_flush(recorder):
+    rows = make_rows(11)
+    publish_rows(rows[:10])
+    handler = bot.SubscriptionHandler(10, bot = recorder)
+    handler.setup()
+    # Subscribed while hike 11 is being fetched: the add is still queued when it is published
+    bot.__subscription_queue__.put(dict(subscription(7, 'all', 'eventsall', 10), action = 'add'))
+    publish_rows(rows)
+    bot.notify_new_hikes(recorder, [hike for hike in bot.__snapshot__.store.hikes if hike.id == 11], 11)
+    assert recorder.messages == []
+    handler.task()
+    assert len(recorder.messages) == 1
+    assert 'Hike number 11' in recorder.messages[0][1]
+    assert bot.__subscriptions__.current()['7_all']['last_id'] == 11
+    handler.task()
+    handler.cleanup()
+
+
+def test_a_failing_command_does_not_block_other_subscriptions(recorder):
+    publish_rows(make_rows(10))
+    broken = subscription(1, 'broken', 'eventsdate 01.06.2024', 0)
+    broken['command']['date_from'] = '24-06-01'
+    working = subscription(2, 'all', 'eventsall', 0)
+    bot.__subscriptions__.replace({ broken['id']: broken, working['id']: working })
+    bot.notify_new_hikes(recorder, bot.__snapshot__.store.hikes, bot.__snapshot__.latest_id)
+    assert [chat_id for chat_id, text in recorder.messages] == [2]
+    bot.__subscriptions__.replace({ broken['id']: broken, working['id']: dict(working, last_id = 0) })
+    recorder.messages = []
+    bot.send_subscriptions(recorder, None)
+    assert [chat_id for chat_id, text in recorder.messages] == [2]
+
+
+def test_subscription_updates_are_kept_when_the_flush_fails():
+    handler = bot.SubscriptionHandler(10)
+    handler.setup()
+    bot.__subscription_queue__.put(dict(subscription(7, 'all', 'eventsall', 0), action = 'add'))
+    bot.__subscription_queue__.put(dict(subscription(8, 'all', 'eventsall', 0), action = 'add'))
+    # A closed connection fails the transaction like a locked or full database would
+    handler.conn.close()
+    handler.task()
+    assert bot.__subscriptions__.current() == {}
+    bot.__subscription_queue__.put(dict(subscription(8, 'all', 'eventsall', 0), action = 'remove'))
+    handler.conn = sqlite3.connect(bot.DATABASE)
+    handler.task()
+    assert list(bot.__subscriptions__.current()) == ['7_all']
+    assert [row[0] for row in handler.conn.execute('SELECT id FROM subscriptions')] == ['7_all']
+    handler.cleanup()
+
+
+def hike_row(hike_id, difficulty, date):
+    return ['', 'Hike number %d' % hike_id, difficulty, 'Organiser',
+        '%d,%d,%d,%d,%d,%02d' % (date.weekday(), date.day, date.month, date.year, date.hour, date.minute),
+        str(hike_id)]
+
+
+def test_catch_up_skips_hikes_already_matched_against_every_subscription(recorder):
+    today = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    handler = bot.SubscriptionHandler(10, bot = recorder)
+    handler.setup()
+    publish_rows([hike_row(1, 'T5', today)])
+    week = subscription(7, 'hard', 'eventsweek T4', 1)
+    bot.__subscriptions__.replace({ week['id']: week })
+    # Hike 2 is far off, so it matches nothing and the subscription keeps last_id 1
+    publish_rows([hike_row(1, 'T5', today), hike_row(2, 'T5', today + timedelta(40))])
+    bot.notify_new_hikes(recorder, [hike for hike in bot.__snapshot__.store.hikes if hike.id == 2], 2)
+    bot.record_notified(2)
+    handler.task()
+    assert bot.__subscriptions__.current()[week['id']]['last_id'] == 1
+    assert bot.load_notified_id() == 2
+    # Weeks later hike 2 is in the current week. It is not new any more
+    publish_rows([hike_row(1, 'T5', today), hike_row(2, 'T5', today)])
+    bot.send_subscriptions(recorder, None)
+    assert recorder.messages == []
+    # A hike published after the watermark is still caught up
+    publish_rows([hike_row(1, 'T5', today), hike_row(2, 'T5', today), hike_row(3, 'T5', today)])
+    bot.send_subscriptions(recorder, None)
+    assert len(recorder.messages) == 1
+    assert 'Hike number 3' in recorder.messages[0][1] and 'Hike number 2' not in recorder.messages[0][1]
+    handler.cleanup()
@@ -0,0 +1,39 @@
+import time
+
+import bot
+
+
+def test_token_bucket_is_full_again_after_refilling():
+    bucket = bot.TokenBucket(100)
+    assert bucket.full()
+    bucket.reserve()
+    assert not bucket.full()
+    time.sleep(0.02)
+    assert bucket.full()
+
+
+def test_outbound_queue_sends_to_every_chat(recorder):
+    outbox = bot.OutboundQueue(recorder, workers = 2, global_rate = 1000, chat_rate = 1000)
+    outbox.start()
+    try:
+        for chat_id in range(100):
+            outbox.put(chat_id, 'message %d' % chat_id)
+        deadline = time.time() + 10
+        while len(recorder.messages) < 100 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        outbox.stop(5)
+    assert sorted(chat_id for chat_id, text in recorder.messages) == list(range(100))
+
+
+def test_sweep_drops_the_full_rate_limits_of_idle_chats(recorder):
+    outbox = bot.OutboundQueue(recorder, chat_rate = 1)
+    for chat_id in range(3000):
+        outbox.chat_buckets[chat_id] = bot.TokenBucket(1)
+    # Chat 0 was just sent to and chat 1 is being sent to
+    outbox.chat_buckets[0].reserve()
+    outbox.busy.add(1)
+    with outbox.cond:
+        outbox.sweep_buckets()
+    assert sorted(outbox.chat_buckets) == [0, 1]
+    assert outbox.sweep_size == bot.CHAT_BUCKETS_SWEEP
@@ -0,0 +1,72 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import bot
+from common import make_payload, make_rows
+
+
+@pytest.mark.parametrize('value', ['', '6,1,6,2024,8', '6,1,6,24,8,00', 'x,1,6,2024,8,00', '6,1,6,2024,8,00,1'])
+def test_parse_date_string_rejects_malformed_dates(value):
+    with pytest.raises(ValueError):
+        bot.parse_date_string(value)
+
+
+def test_parse_date_string_rejects_impossible_dates():
+    with pytest.raises(ValueError):
+        bot.parse_date_string('0,31,2,2024,8,00')
+
+
+def test_parse_date_string():
+    assert bot.parse_date_string('5,1,6,2024,8,30') == datetime(2024, 6, 1, 8, 30)
+
+
+def test_parse_hike_rejects_short_rows():
+    with pytest.raises(ValueError):
+        bot.parse_hike(['', 'Name', 'T2', 'Organiser', '5,1,6,2024,8,30'])
+
+
+def test_parse_hike_defaults_unknown_difficulties_to_t0():
+    hike = bot.parse_hike(['', 'Name', 'T9', 'Organiser', '5,1,6,2024,8,30', '42'])
+    assert (hike.id, hike.name, hike.difficulty, hike.organiser) == (42, 'Name', bot.Difficulty.T0, 'Organiser')
+
+
+def test_refresh_skips_bad_rows():
+    rows = make_rows(3)
+    bad = [['', 'Short row'], ['', 'Bad date', 'T1', 'Organiser', 'tomorrow', '100']]
+    changes = bot.HikesLoader(30).refresh(rows[:1] + bad + rows[1:])
+    assert sorted(hike.id for hike in changes.added) == [1, 2, 3]
+
+
+def test_refresh_parses_only_changed_rows():
+    rows = make_rows(3)
+    loader = bot.HikesLoader(30)
+    loader.refresh(rows)
+    rows[1] = rows[1][:2] + ['T6'] + rows[1][3:]
+    changes = loader.refresh(rows[1:])
+    assert changes.added == []
+    assert [(hike.id, hike.difficulty) for hike in changes.updated] == [(2, bot.Difficulty.T6)]
+    assert [hike.id for hike in changes.removed] == [1]
+    assert loader.changed_rows == [rows[1]]
+
+
+def test_json_backend_can_be_forced(monkeypatch):
+    monkeypatch.setattr(bot, '__json_loads__', None)
+    monkeypatch.setenv('HBM_JSON_BACKEND', 'json')
+    assert bot.get_json_loads() is json.loads
+
+
+def test_missing_json_backend_raises(monkeypatch):
+    monkeypatch.setattr(bot, '__json_loads__', None)
+    monkeypatch.setenv('HBM_JSON_BACKEND', 'no_such_json_backend')
+    with pytest.raises(ImportError):
+        bot.get_json_loads()
+
+
+def test_iter_event_rows_yields_every_row():
+    rows = make_rows(50)
+    payload = make_payload(rows)
+    assert list(bot.iter_event_rows(io.BytesIO(payload))) == rows
+    assert bot.decode_event_list(payload)['data'] == rows
@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import pytest
+from telegram.ext import Updater
+
+import bot
+from common import make_rows
+from fakes import FakeTelegram, FakeUpstream
+
+pytestmark = pytest.mark.usefixtures('clean_state')
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    upstream = FakeUpstream(make_rows(30)).start()
+    telegram = FakeTelegram().start()
+    monkeypatch.setattr(bot, 'EVENT_LIST_URL', upstream.url)
+    # Keeps the long poll that is running at shutdown short
+    monkeypatch.setattr(bot, 'UPDATES_POLL_TIMEOUT', 1)
+    yield upstream, telegram
+    telegram.stop()
+    upstream.stop()
+
+
+def wait_until(condition, timeout = 10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def start_runtime(telegram):
+    updater = Updater(token = '123456:TEST', base_url = telegram.base_url)
+    bot.add_handlers(updater.dispatcher)
+    loader = bot.HikesLoader(30, bot.AdaptiveScheduler(30), updater.bot)
+    persister = bot.SubscriptionHandler(10, bot = updater.bot)
+    runtime = bot.AsyncRuntime(updater.bot, updater.dispatcher, loader, persister, catch_up_delay = 0)
+    thread = threading.Thread(target = runtime.run)
+    thread.start()
+    wait_until(lambda: runtime.stopping is not None)
+    return runtime, thread, loader
+
+
+def test_async_runtime_answers_commands_and_shuts_down(servers):
+    upstream, telegram = servers
+    runtime, thread, loader = start_runtime(telegram)
+    try:
+        wait_until(lambda: bot.__snapshot__.generation > 0)
+        telegram.push_command(5, '/eventsall')
+        messages = telegram.wait_for_messages(5)
+        assert 'Hike number 1' in ''.join(message['text'] for message in messages)
+        telegram.push_command(5, '/subscribe all eventsall')
+        assert telegram.wait_for_messages(5, len(messages) + 1)[-1]['text'] == 'all subscription added'
+    finally:
+        runtime.stop()
+        thread.join(10)
+    assert not thread.is_alive()
+    # The last flush on shutdown writes the queued subscription
+    with closing(sqlite3.connect(bot.DATABASE)) as conn:
+        assert conn.execute("SELECT id FROM subscriptions").fetchall() == [('5_all',)]
+
+
+def test_refresh_now_wakes_the_async_loader(servers):
+    upstream, telegram = servers
+    runtime, thread, loader = start_runtime(telegram)
+    try:
+        wait_until(lambda: bot.__snapshot__.generation > 0)
+        requests = upstream.requests
+        # The next scheduled fetch is more than 10 seconds away
+        loader.refresh_now()
+        wait_until(lambda: upstream.requests > requests, timeout = 5)
+    finally:
+        runtime.stop()
+        thread.join(10)
+    assert not thread.is_alive()
+    assert loader.wake_callbacks == []
@@ -0,0 +1,70 @@
+import http.client
+import json
+import threading
+
+import pytest
+import requests
+
+import bot
+from fakes import command_update
+
+
+class BlockingDispatcher(object):
+
+    # Records the processed updates and holds every one until release is set
+    def __init__(self):
+        self.release = threading.Event()
+        self.updates = []
+
+    def process_update(self, update):
+        self.release.wait(10)
+        self.updates.append(update.update_id)
+
+
+@pytest.fixture
+def webhook():
+    dispatcher = BlockingDispatcher()
+    server = bot.WebhookServer(None, dispatcher, 0, path = '/webhook', secret = 'secret', max_pending = 1)
+    server.start()
+    yield server
+    dispatcher.release.set()
+    server.stop()
+
+
+def post(webhook, body, secret = 'secret'):
+    headers = { 'Content-Type': 'application/json' }
+    if secret is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    url = 'http://127.0.0.1:%d/webhook' % webhook.server.server_address[1]
+    return requests.post(url, data = body, headers = headers, timeout = 5)
+
+
+def test_webhook_rejects_a_wrong_or_missing_secret(webhook):
+    body = json.dumps(command_update(1, 5, '/eventsall'))
+    assert post(webhook, body, secret = 'wrong').status_code == 403
+    assert post(webhook, body, secret = None).status_code == 403
+    assert webhook.pending == 0
+
+
+def test_webhook_rejects_an_oversize_body(webhook):
+    # Rejected on the announced length, so the body is never sent
+    conn = http.client.HTTPConnection('127.0.0.1', webhook.server.server_address[1], timeout = 5)
+    try:
+        conn.putrequest('POST', '/webhook')
+        conn.putheader('X-Telegram-Bot-Api-Secret-Token', 'secret')
+        conn.putheader('Content-Length', str(bot.WEBHOOK_MAX_BODY + 1))
+        conn.endheaders()
+        assert conn.getresponse().status == 413
+    finally:
+        conn.close()
+    assert webhook.pending == 0
+
+
+def test_webhook_sheds_updates_while_the_queue_is_full(webhook):
+    assert post(webhook, json.dumps(command_update(1, 5, '/eventsall'))).status_code == 200
+    response = post(webhook, json.dumps(command_update(2, 5, '/eventsall')))
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    webhook.dispatcher.release.set()
+    webhook.pool.shutdown(wait = True)
+    assert webhook.dispatcher.updates == [1]